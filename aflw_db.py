@@ -0,0 +1,107 @@
+import os.path as osp
+import shutil
+import sqlite3
+import tempfile
+
+# Columns used by the joins of the AFLW queries; each one of them needs to be indexed, otherwise SQLite has to scan the
+# joined table for every face.
+REQUIRED_INDEXES = (('faces', 'face_id'),
+                    ('faces', 'file_id'),
+                    ('faceimages', 'file_id'),
+                    ('facerect', 'face_id'),
+                    ('facepose', 'face_id'),
+                    ('facemetadata', 'face_id'),
+                    ('featurecoords', 'face_id'))
+
+
+def build_query(select_str, from_str, where_str=None, order_by_str=None):
+    query_str = 'SELECT {}'.format(select_str)
+    query_str += ' FROM {}'.format(from_str)
+    if where_str:
+        query_str += ' WHERE {}'.format(where_str)
+    if order_by_str:
+        query_str += ' ORDER BY {}'.format(order_by_str)
+    return query_str
+
+
+def is_indexed(conn, table, column):
+    """Check whether the given column is usable for index lookups, i.e., whether it is the (rowid alias) primary key of
+    the table or the first column of an index on the table."""
+    table_info = conn.execute('PRAGMA table_info("{}")'.format(table)).fetchall()
+    pk_columns = [row for row in table_info if row[5] > 0]
+    if len(pk_columns) == 1 and pk_columns[0][1] == column and pk_columns[0][2].upper() == 'INTEGER':
+        return True
+    for index_row in conn.execute('PRAGMA index_list("{}")'.format(table)).fetchall():
+        index_info = conn.execute('PRAGMA index_info("{}")'.format(index_row[1])).fetchall()
+        if any(seqno == 0 and name == column for seqno, _, name in index_info):
+            return True
+    return False
+
+
+class AFLWDatabase(object):
+    """Read-only access to the AFLW SQLite database.
+
+    The database is opened in read-only, immutable mode (no locking, no journal). If any of the indexes needed by the
+    joins of the AFLW queries (see `REQUIRED_INDEXES`) is missing, the database is copied into a temporary file where
+    the missing indexes are created; the original database file is never modified. Query results are streamed in
+    batches (using `fetchmany()`), instead of being materialized into a list; `num_rows` counts the rows fetched so far.
+
+    Args:
+        filename (str): AFLW SQLite database file (i.e., `aflw.sqlite`)
+        batch_size (int): number of rows fetched at once while streaming query results
+        create_indexes (bool): create missing indexes (in a temporary copy of the database)
+    """
+    def __init__(self, filename, batch_size=4096, create_indexes=True):
+        self.filename = filename
+        self.batch_size = batch_size
+        self.tmp_dir = None
+        self.num_rows = 0
+        self.conn = sqlite3.connect('file:{}?mode=ro&immutable=1'.format(osp.abspath(filename)), uri=True)
+        self.created_indexes = []
+        if create_indexes:
+            missing_indexes = [(table, column) for table, column in REQUIRED_INDEXES
+                               if not is_indexed(self.conn, table, column)]
+            if missing_indexes:
+                self._create_indexes(missing_indexes)
+
+    def _create_indexes(self, indexes):
+        self.tmp_dir = tempfile.mkdtemp(prefix='aflw_db_')
+        tmp_conn = sqlite3.connect(osp.join(self.tmp_dir, osp.basename(self.filename)))
+        self.conn.backup(tmp_conn)
+        self.conn.close()
+        for table, column in indexes:
+            tmp_conn.execute('CREATE INDEX "idx_{0}_{1}" ON "{0}" ("{1}")'.format(table, column))
+        tmp_conn.commit()
+        self.conn = tmp_conn
+        self.created_indexes = indexes
+
+    def query(self, select_str, from_str, where_str=None, order_by_str=None):
+        """Stream the rows of the given query. Each call uses its own cursor, so that the results of several queries can
+        be consumed concurrently."""
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute(build_query(select_str, from_str, where_str, order_by_str))
+            rows = cursor.fetchmany(self.batch_size)
+            while rows:
+                self.num_rows += len(rows)
+                for row in rows:
+                    yield row
+                rows = cursor.fetchmany(self.batch_size)
+        finally:
+            cursor.close()
+
+    def count(self, from_str, where_str=None, count_str='*'):
+        """Count the rows of the given query (e.g., `count_str='DISTINCT imgs.filepath'` counts unique image paths)."""
+        return self.conn.execute(build_query('COUNT({})'.format(count_str), from_str, where_str)).fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+        if self.tmp_dir is not None:
+            shutil.rmtree(self.tmp_dir, ignore_errors=True)
+            self.tmp_dir = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,79 @@
+import argparse
+import os.path as osp
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from PIL import Image
+from image_size import get_img_size_header, get_img_size_pil
+
+
+def build_synthetic_images(out_dir, num_images, seed=0):
+    """Build a set of synthetic JPEG/PNG images of random sizes (some of the JPEGs carry an EXIF segment before the
+    start-of-frame segment, as most Flickr images do)."""
+    rng = random.Random(seed)
+    image_filenames = []
+    for i in range(num_images):
+        width, height = rng.randint(64, 1024), rng.randint(64, 1024)
+        img = Image.new('RGB', (width, height), (rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255)))
+        if i % 4 == 0:
+            image_filename = osp.join(out_dir, 'image{:05d}.png'.format(i))
+            img.save(image_filename)
+        else:
+            image_filename = osp.join(out_dir, 'image{:05d}.jpg'.format(i))
+            exif = Image.Exif()
+            exif[0x010e] = 'x' * rng.randint(0, 16384)  # ImageDescription
+            img.save(image_filename, quality=90, progressive=(i % 3 == 0), exif=exif)
+        image_filenames.append((image_filename, (width, height)))
+    return image_filenames
+
+
+def time_backend(get_img_size_fn, image_filenames, repeats):
+    """Return the best (over `repeats` runs) mean time per image (in seconds) of the given image size backend."""
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for image_filename, _ in image_filenames:
+            get_img_size_fn(image_filename)
+        best = min(best, (time.perf_counter() - start) / len(image_filenames))
+    return best
+
+
+def time_import(module):
+    """Return the time (in seconds) needed for importing the given module in a fresh interpreter."""
+    start = time.perf_counter()
+    subprocess.check_call([sys.executable, '-c', 'import {}'.format(module)], cwd=osp.dirname(osp.abspath(__file__)))
+    return time.perf_counter() - start
+
+
+def main():
+    # Set up a parser for command line arguments
+    parser = argparse.ArgumentParser("Benchmark image size backends (header parsing vs PIL) on synthetic images")
+    parser.add_argument('-n', '--num_images', type=int, default=1000, help="number of synthetic images")
+    parser.add_argument('-r', '--repeats', type=int, default=5, help="number of timed runs per backend")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        print("#. Build {} synthetic images...".format(args.num_images))
+        image_filenames = build_synthetic_images(tmp_dir, args.num_images)
+
+        # Both backends must agree with the ground truth size of each image
+        for image_filename, img_size in image_filenames:
+            assert get_img_size_header(image_filename) == img_size, image_filename
+            assert get_img_size_pil(image_filename) == img_size, image_filename
+
+        print("#. Time image size backends (best of {} runs)...".format(args.repeats))
+        t_header = time_backend(get_img_size_header, image_filenames, args.repeats)
+        t_pil = time_backend(get_img_size_pil, image_filenames, args.repeats)
+        t_interpreter = time_import('sys')
+        t_import_pil = time_import('PIL.Image') - t_interpreter
+        t_import_header = time_import('image_size') - t_interpreter
+
+    print("  \\__header : {:8.2f} us/image (import: {:6.1f} ms)".format(1e6 * t_header, 1e3 * t_import_header))
+    print("  \\__pil    : {:8.2f} us/image (import: {:6.1f} ms)".format(1e6 * t_pil, 1e3 * t_import_pil))
+    print("  \\__speedup: {:.1f}x".format(t_pil / t_header))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+import json
+import re
+import shutil
+import tempfile
+# Reading and opening (possibly compressed) json files is part of the `data` package, and re-exported here
+from data.json_io import COMPRESSIONS, get_compression, open_json, load_json
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_NUMBER_CHARS = re.compile(r'[0-9.eE+\-]*')
+_STRUCTURE_CHARS = re.compile(r'[\[\]{}"]')
+_STRING = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"')
+
+
+def format_record(record, compact=False, precision=None):
+    """Format an image or annotation record for writing: with `compact`, empty fields (e.g., `'segmentation': []` or
+    `'flickr_url': ''`) are dropped, and, if `precision` is given, float values (e.g., bounding box and keypoint
+    coordinates) are rounded to `precision` decimal digits."""
+    def _round(value):
+        if isinstance(value, float):
+            return round(value, precision) if precision > 0 else int(round(value))
+        if isinstance(value, (list, tuple)):
+            return [_round(v) for v in value]
+        return value
+
+    if compact:
+        record = {key: value for key, value in record.items() if value not in ('', [], (), {})}
+    if precision is not None:
+        record = {key: _round(value) for key, value in record.items()}
+    return record
+
+
+def get_json_separators(compact=False):
+    return (',', ':') if compact else (', ', ': ')
+
+
+def save_json(dataset_dict, filename, compact=False, precision=None, compression='auto'):
+    """Save a COCO-style dataset dictionary as a (possibly compressed) json file; with `compact` and/or `precision`, its
+    image and annotation records are formatted by `format_record()`, and, with `compact`, no whitespace is written."""
+    if compact or precision is not None:
+        dataset_dict = dict(dataset_dict)
+        for key in ('images', 'annotations'):
+            if key in dataset_dict:
+                dataset_dict[key] = [format_record(record, compact, precision) for record in dataset_dict[key]]
+    with open_json(filename, 'w', compression=compression) as fp:
+        json.dump(dataset_dict, fp, separators=get_json_separators(compact))
+
+
+class COCOStreamReader(object):
+    """Read a COCO-style json file incrementally, so that peak memory does not depend on the size of the dataset.
+
+    The (possibly compressed) file is read in chunks and decoded one top-level entry at a time, except for the entries
+    in `stream_keys` (by default, images and annotations), whose lists are decoded one element at a time. Entries that
+    are not asked for (e.g., the streamed lists, when reading the header) are skipped by only scanning their brackets
+    and strings, without decoding them. Only the standard library json decoder is used.
+
+    Example:
+        reader = COCOStreamReader('aflw_annotations.json')
+        header = reader.header()                  # e.g., dataset info, licenses, and categories
+        for key, record in reader.iter_streams(('images', 'annotations')):
+            ...
+
+    Args:
+        filename (str): input json file
+        stream_keys (tuple): top-level keys of (large) lists that are read one element at a time
+        chunk_size (int): read chunk size (in characters)
+    """
+    def __init__(self, filename, stream_keys=('images', 'annotations'), chunk_size=1 << 20):
+        self.filename = filename
+        self.stream_keys = stream_keys
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        # Top-level keys of the file, in order (known once the file has been read through, e.g., by `header()`)
+        self.keys = None
+
+    def header(self):
+        """Return a dictionary with all top-level entries of the file except for the ones in `stream_keys`, which are
+        skipped (without being decoded or kept in memory)."""
+        return {key: value for event, key, value in self._iter_entries(values=True)}
+
+    def iter_records(self, key):
+        """Iterate over the elements of the top-level list `key` (one of `stream_keys`)."""
+        for _, record in self.iter_streams((key,)):
+            yield record
+
+    def iter_streams(self, keys):
+        """Iterate over the elements of the top-level lists `keys` (some of `stream_keys`) in a single pass over the
+        file, i.e., in the order they appear in the file, as (key, element) tuples. Reading stops once all the lists
+        have been read."""
+        for key in keys:
+            if key not in self.stream_keys:
+                raise ValueError("Not a streamed key: {}".format(key))
+        for event, key, value in self._iter_entries(record_keys=keys):
+            yield key, value
+
+    def _iter_entries(self, record_keys=(), values=False):
+        """Yield ('record', key, element) for each element of the streamed entries in `record_keys` and, with `values`,
+        ('value', key, value) for each top-level entry that is not streamed; other entries are skipped."""
+        remaining = set(record_keys)
+        keys = []
+        with open_json(self.filename, 'r') as fp:
+            self.fp, self.buf, self.pos, self.eof = fp, '', 0, False
+            self._expect('{')
+            if self._peek() == '}':
+                self.keys = keys
+                return
+            while True:
+                key = self._decode()
+                keys.append(key)
+                self._expect(':')
+                if key in self.stream_keys and self._peek() == '[':
+                    if key not in remaining:
+                        self._skip()
+                    else:
+                        self._expect('[')
+                        if self._peek() == ']':
+                            self.pos += 1
+                        else:
+                            while True:
+                                yield 'record', key, self._decode()
+                                if self._next_delimiter(']'):
+                                    break
+                        remaining.discard(key)
+                        if not remaining and not values:
+                            return
+                elif values:
+                    yield 'value', key, self._decode()
+                else:
+                    self._skip()
+                if self._next_delimiter('}'):
+                    self.keys = keys
+                    return
+
+    def _fill(self, size=None):
+        chunk = self.fp.read(size or self.chunk_size)
+        self.eof = not chunk
+        self.buf, self.pos = self.buf[self.pos:] + chunk, 0
+
+    def _peek(self):
+        while True:
+            self.pos = _WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if self.eof:
+                return ''
+            self._fill()
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ValueError("Invalid COCO json file {}: expected '{}'".format(self.filename, char))
+        self.pos += 1
+
+    def _next_delimiter(self, closing):
+        """Consume the delimiter following a value; return True if it closes the enclosing list/object."""
+        char = self._peek()
+        if char not in (',', closing):
+            raise ValueError("Invalid COCO json file {}: expected ',' or '{}'".format(self.filename, closing))
+        self.pos += 1
+        return char == closing
+
+    def _skip(self):
+        """Skip a value without decoding it, i.e., by only scanning the brackets and strings of lists and objects."""
+        if self._peek() not in ('[', '{'):
+            self._decode()
+            return
+        depth = 0
+        while True:
+            match = _STRUCTURE_CHARS.search(self.buf, self.pos)
+            if match is None:
+                self.pos = len(self.buf)
+            elif match.group() == '"':
+                string = _STRING.match(self.buf, match.start())
+                if string is not None:
+                    self.pos = string.end()
+                    continue
+                # Incomplete string: read more (from its start)
+                self.pos = match.start()
+            else:
+                self.pos = match.end()
+                depth += 1 if match.group() in '[{' else -1
+                if depth == 0:
+                    return
+                continue
+            if self.eof:
+                raise ValueError("Invalid COCO json file {}: unexpected end of file".format(self.filename))
+            self._fill(max(self.chunk_size, len(self.buf) - self.pos))
+
+    def _decode(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if self.eof:
+                    raise
+                # Incomplete value: read more (at least doubling the buffer, so that large values are decoded in
+                # amortized linear time)
+                self._fill(max(self.chunk_size, len(self.buf) - self.pos))
+                continue
+            # A number at the end of the buffer may continue in the next chunk (e.g., '1' of '1.5' is decoded as 1)
+            if not self.eof and isinstance(value, (int, float)) and \
+                    _NUMBER_CHARS.match(self.buf, end).end() == len(self.buf):
+                self._fill(max(self.chunk_size, len(self.buf) - self.pos))
+                continue
+            self.pos = end
+            return value
+
+
+class COCOStreamWriter(object):
+    """Write a COCO-style json file incrementally, so that peak memory does not depend on the size of the dataset.
+
+    The header (e.g., dataset info and licenses) is written on construction, images are written straight to the output
+    file as they are added, while annotations are spooled to a temporary file and appended after the images list on
+    `close()`, followed by the footer (e.g., dataset categories). The output is equivalent to calling `save_json()` on a
+    dictionary with the same (ordered) contents.
+
+    Args:
+        filename (str): output json file
+        header (dict): top-level entries written before images
+        footer (dict): top-level entries written after annotations
+        compact (bool): drop empty fields of records and write no whitespace (see `format_record()`)
+        precision (int, optional): number of decimal digits of float values
+        compression (str): compression format (see `open_json()`)
+    """
+    def __init__(self, filename, header, footer, compact=False, precision=None, compression='auto'):
+        self.footer = footer
+        self.compact = compact
+        self.precision = precision
+        self.separators = get_json_separators(compact)
+        self.num_images = 0
+        self.num_annotations = 0
+        self.fp = open_json(filename, 'w', compression=compression)
+        self.spool = tempfile.TemporaryFile(mode='w+')
+        self.fp.write(self._dumps(header)[:-1])
+        self.fp.write('{}"images"{}['.format(self.separators[0] if header else '', self.separators[1]))
+
+    def _dumps(self, obj):
+        return json.dumps(obj, separators=self.separators)
+
+    def add_image(self, image):
+        self.fp.write('{}{}'.format(self.separators[0] if self.num_images else '',
+                                    self._dumps(format_record(image, self.compact, self.precision))))
+        self.num_images += 1
+
+    def add_annotation(self, annotation):
+        self.spool.write('{}{}'.format(self.separators[0] if self.num_annotations else '',
+                                       self._dumps(format_record(annotation, self.compact, self.precision))))
+        self.num_annotations += 1
+
+    def close(self):
+        self.fp.write(']{}"annotations"{}['.format(*self.separators))
+        self.spool.seek(0)
+        shutil.copyfileobj(self.spool, self.fp)
+        self.spool.close()
+        self.fp.write(']')
+        if self.footer:
+            self.fp.write('{}{}'.format(self.separators[0], self._dumps(self.footer)[1:]))
+        else:
+            self.fp.write('}')
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -1,17 +1,6 @@
-import sys
 import argparse
 from data import *
-
-
-def progress_updt(msg, total, progress):
-    bar_length, status = 20, ""
-    progress = float(progress) / float(total)
-    if progress >= 1.:
-        progress, status = 1, "\r\n"
-    block = int(round(bar_length * progress))
-    text = "\r{}[{}] {:.0f}% {}".format(msg, "#" * block + "-" * (bar_length - block), round(progress * 100, 0), status)
-    sys.stdout.write(text)
-    sys.stdout.flush()
+from instrumentation import ProgressReporter
 
 
 def main():
@@ -20,10 +9,15 @@ def main():
     parser.add_argument('-v', '--verbose', action='store_true', help="increase output verbosity")
     parser.add_argument('--dataset_root', type=str, required=True, help='AFLW root directory')
     parser.add_argument('--json', type=str, default='aflw_annotations.json', help="COCO json annotation file")
+    parser.add_argument('--cache_mb', type=int, default=0,
+                        help="size (in MB) of the cache of decoded images (0 for no cache)")
+    parser.add_argument('--read_ahead', type=int, default=0,
+                        help="number of images read ahead by a background thread pool (0 for no read-ahead)")
     args = parser.parse_args()
 
     # Build data loader
-    dataset = AFLW(root=args.dataset_root, json=args.json, transform=None)
+    dataset = AFLW(root=args.dataset_root, json=args.json, transform=None, image_cache_mb=args.cache_mb,
+                   read_ahead=args.read_ahead)
 
     # Total number of images in dataset
     num_images = len(dataset)
@@ -40,6 +34,10 @@ def main():
     bbox_areas = []
     bbox_labels = []
     per_channel_sum = np.zeros((1, 3))
+    if dataset.prefetcher is not None:
+        dataset.prefetcher.set_order(range(num_images))
+    progress = ProgressReporter("  \\__Processing ", num_images, name='statistics', unit='images') \
+        if args.verbose and num_images else None
     for i in range(num_images):
         img, gt, img_h, img_w, _, _ = dataset.pull_item(i)
         img_widths.append(img_w)
@@ -54,8 +52,8 @@ def main():
             bbox_areas.append(bbox_widths[-1] * bbox_heights[-1])
         per_channel_sum += img.squeeze(0).float().view(3, -1).mean(dim=1).numpy()
 
-        if args.verbose:
-            progress_updt("  \\__Processing ", num_images, i + 1)
+        if progress is not None:
+            progress.update(i + 1)
 
     img_widths = np.array(img_widths)
     img_heights = np.array(img_heights)
@@ -74,6 +72,16 @@ def main():
         print("  \\__Bbox areas       : mean = {} (std={})".format(int(bbox_areas.mean()), int(bbox_areas.std())))
         print("  \\__Bbox diagonals   : mean = {} (std={})".format(int(bbox_diags.mean()), int(bbox_diags.std())))
         print("  \\__Per channel mean : {}".format(per_channel_mean.astype(np.int)[0]))
+        if dataset.image_cache is not None:
+            cache_stats = dataset.image_cache.stats()
+            print("  \\__Image cache      : {} hits, {} misses ({} images, {:.1f} MB)".format(
+                cache_stats['hits'], cache_stats['misses'], cache_stats['images'], cache_stats['bytes'] / 2 ** 20))
+        if dataset.prefetcher is not None:
+            prefetch_stats = dataset.prefetcher.stats()
+            print("  \\__Read-ahead       : {} hits, {} waits, {} misses".format(
+                prefetch_stats['hits'], prefetch_stats['waits'], prefetch_stats['misses']))
+    if dataset.prefetcher is not None:
+        dataset.prefetcher.close()
 
     # Save dictionary of dataset's statistics
     dataset_statistics_dict = {
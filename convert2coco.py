@@ -2,37 +2,444 @@ import argparse
 import sys
 import os
 import os.path as osp
-import sqlite3
 import json
 import re
-from PIL import Image
+import stat
+import time
+import heapq
+import numpy as np
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from image_size import get_img_size
+from aflw_db import AFLWDatabase
+from coco_io import COCOStreamWriter, get_compression, open_json, save_json
+from manifest import file_stat, file_fingerprint, load_manifest, save_manifest
+from instrumentation import ProgressReporter, StageProfiler
 
 # Number of facial landmarks provided by AFLW dataset
 N_LANDMARK = 21
 
+# Arrays of the binary columnar annotation bundle (see `AnnotationBundleWriter`)
+BUNDLE_ARRAYS = ('image_ids', 'path_offsets', 'paths', 'widths', 'heights', 'face_offsets', 'face_ids', 'boxes',
+                 'category_ids', 'keypoints', 'pose', 'gender')
+
+# Bin edges (absolute yaw angle, in degrees) of the pose strata used for stratified splits
+POSE_BIN_EDGES = (15, 30, 45, 60, 75)
+
+# =============================== Dataset Info =============================== #
+DATASET_INFO = {
+    'description': 'Annotated Facial Landmarks in the Wild (AFLW)',
+    'url': 'https://www.tugraz.at/institute/icg/research/team-bischof/lrs/downloads/aflw/',
+    'version': '1.0',
+    'year': 2011,
+    'contributor': '',
+    'date_created': '2011'
+}
+
+# ============================= Dataset Licenses ============================= #
+DATASET_LICENSES = [
+    {'id': 0,
+     'url': 'https://www.tugraz.at/institute/icg/research/team-bischof/lrs/downloads/aflw/',
+     'name': 'aflw_license'}
+]
+
+# ============================ Dataset Categories ============================ #
+DATASET_CATEGORIES = [
+    {'supercategory': 'face',
+     'name': 'face',
+     'skeleton': [],
+     'keypoints': ['LeftBrowLeftCorner',
+                   'LeftBrowCenter',
+                   'LeftBrowRightCorner',
+                   'RightBrowLeftCorner',
+                   'RightBrowCenter',
+                   'RightBrowRightCorner',
+                   'LeftEyeLeftCorner',
+                   'LeftEyeCenter',
+                   'LeftEyeRightCorner',
+                   'RightEyeLeftCorner',
+                   'RightEyeCenter',
+                   'RightEyeRightCorner',
+                   'LeftEar',
+                   'NoseLeft',
+                   'NoseCenter',
+                   'NoseRight',
+                   'RightEar',
+                   'MouthLeftCorner',
+                   'MouthCenter',
+                   'MouthRightCorner',
+                   'ChinCenter'],
+     'id': 0}
+]
+
+
+def probe_image(image_filename, cached=None, backend='header'):
+    """Probe the given image file.
+
+    Args:
+        image_filename (str): image file
+        cached (list, optional): a previous probe result of the image file; if the size and the modification time of
+                                 the file have not changed since, the cached image size is reused
+        backend (str): image size backend (see `image_size.get_img_size()`)
+
+    Returns:
+        [file size, file modification time (ns), width, height], or None if the file does not exist
+    """
+    try:
+        st = os.stat(image_filename)
+    except OSError:
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    if cached is not None and cached[:2] == [st.st_size, st.st_mtime_ns]:
+        return cached
+    width, height = get_img_size(image_filename, backend)
+    return [st.st_size, st.st_mtime_ns, width, height]
+
+
+def probe_images(image_filenames, cache=None, workers=8, executor='thread', backend='header', callback=None):
+    """Probe the given image files using a pool of workers.
+
+    Probing is I/O-latency bound (a stat and a header read per file), so a pool of threads is usually enough to hide the
+    latency of network-mounted dataset roots; a pool of processes can be used instead if decoding headers turns out to
+    be CPU bound.
+
+    Args:
+        image_filenames (list): image files to probe (each file is probed once, so pass unique filenames)
+        cache (dict, optional): previous probe results (image filename -> probe result, see `probe_image()`); image
+                                sizes are only read for new or changed image files
+        workers (int): number of workers (if 0, images are probed serially in the calling thread)
+        executor (str): type of workers ('thread' or 'process')
+        backend (str): image size backend (see `image_size.get_img_size()`)
+        callback (callable, optional): called with the number of probed images after each image is probed
+
+    Returns:
+        probed (dict): image filename -> probe result (see `probe_image()`)
+    """
+    cache = cache or dict()
+    cached = [cache.get(image_filename) for image_filename in image_filenames]
+    probe = partial(probe_image, backend=backend)
+    if workers > 0:
+        pool = ThreadPoolExecutor(workers) if executor == 'thread' else ProcessPoolExecutor(workers)
+        chunksize = 1 if executor == 'thread' else max(1, len(image_filenames) // (16 * workers))
+        results = pool.map(probe, image_filenames, cached, chunksize=chunksize)
+    else:
+        pool = None
+        results = map(probe, image_filenames, cached)
+
+    probed = dict()
+    for image_filename, probe_res in zip(image_filenames, results):
+        probed[image_filename] = probe_res
+        if callback is not None:
+            callback(len(probed))
+    if pool is not None:
+        pool.shutdown()
+
+    return probed
+
+
+def get_image_id(img_path):
+    """Build a COCO image id from an AFLW image path (e.g., 'flickr/3/image00035.jpg' -> 300035)."""
+    img_dir_num = int(img_path.split("/")[1])
+    img_file_num = int(re.findall(r'\d+', img_path.split("/")[-1].split(".")[0])[0])
+    return int("%d%05d" % (img_dir_num, img_file_num))
+
+
+def build_keypoints(face_ids, query_res):
+    """Scatter landmark rows into a dense keypoints block.
+
+    (Visibility is expressed by lack of the coordinate's row.)
+
+    Args:
+        face_ids (np.ndarray): ids of the registered faces
+        query_res (iterable): landmark rows `(face_id, feature_id, x, y)`
+
+    Returns:
+        keypoints (np.ndarray): keypoints block of shape (n_faces, N_LANDMARK, 3), where keypoints[i, j] holds the
+                                coordinates and the visibility, (x, y, v), of the j-th landmark of the face face_ids[i]
+        invalid_face_ids (set): ids of faces that have landmarks, but are not registered
+    """
+    coords = np.fromiter(query_res, dtype=[('face_id', np.int64), ('feature_id', np.int64),
+                                           ('x', np.float64), ('y', np.float64)])
+    assert ((1 <= coords['feature_id']) & (coords['feature_id'] <= N_LANDMARK)).all()
+
+    # Find the index of each landmark's face in face_ids
+    face_ids_sorter = np.argsort(face_ids)
+    face_idx = np.searchsorted(face_ids, coords['face_id'], sorter=face_ids_sorter)
+    face_idx[face_idx == len(face_ids)] = 0
+    face_idx = face_ids_sorter[face_idx] if len(face_ids) > 0 else face_idx
+    valid = face_ids[face_idx] == coords['face_id'] if len(face_ids) > 0 else np.zeros(len(coords), dtype=bool)
+
+    keypoints = np.zeros((len(face_ids), N_LANDMARK, 3), dtype=np.float64)
+    feature_idx = coords['feature_id'][valid] - 1
+    keypoints[face_idx[valid], feature_idx, 0] = coords['x'][valid]
+    keypoints[face_idx[valid], feature_idx, 1] = coords['y'][valid]
+    keypoints[face_idx[valid], feature_idx, 2] = 1
+
+    return keypoints, set(coords['face_id'][~valid].tolist())
+
+
+def keypoints_to_list(keypoints):
+    """Convert the (N_LANDMARK, 3) keypoints of a face into a flat COCO-style list [x_1, y_1, v_1, ..., x_N, y_N, v_N],
+    with integer visibility flags, and integer zeros for the coordinates of missing landmarks (i.e., 0, 0, 0)."""
+    coords = keypoints[:, :2].ravel().tolist()
+    keypoints_list = []
+    for x, y, v in zip(coords[0::2], coords[1::2], keypoints[:, 2].tolist()):
+        keypoints_list += [x, y, int(v)] if v else [0, 0, 0]
+    return keypoints_list
+
+
+class AnnotationBundleWriter(object):
+    """Collect face annotations into a binary columnar bundle, i.e., a directory with one .npy file per array, plus a
+    `meta.json` file, that can be loaded with memory mapping (see `data.bundle.load_bundle()`):
+
+        image_ids      (n_images,)           int64    COCO image ids
+        path_offsets   (n_images + 1,)       int64    offsets of each image's file path in `paths`
+        paths          (total path bytes,)   uint8    utf-8 encoded image file paths (relative to the dataset root)
+        widths         (n_images,)           int32    image widths
+        heights        (n_images,)           int32    image heights
+        face_offsets   (n_images + 1,)       int64    faces of the i-th image are face_offsets[i]:face_offsets[i + 1]
+        face_ids       (n_faces,)            int64    COCO annotation ids
+        boxes          (n_faces, 4)          float32  bounding boxes (x, y, w, h)
+        category_ids   (n_faces,)            int32    category ids
+        keypoints      (n_faces, 21, 3)      float32  landmarks (x, y, visibility)
+        pose           (n_faces, 3)          float32  head pose (roll, pitch, yaw), in radians
+        gender         (n_faces,)            uint8    0 for male, 1 for female
+
+    Faces must be added right after their image (i.e., grouped by image).
+
+    Args:
+        max_faces (int): maximum number of faces (face arrays are preallocated and truncated on `save()`)
+    """
+    def __init__(self, max_faces):
+        self.image_ids = []
+        self.paths = []
+        self.widths = []
+        self.heights = []
+        self.face_offsets = [0]
+        self.num_faces = 0
+        self.face_ids = np.zeros(max_faces, dtype=np.int64)
+        self.boxes = np.zeros((max_faces, 4), dtype=np.float32)
+        self.category_ids = np.zeros(max_faces, dtype=np.int32)
+        self.keypoints = np.zeros((max_faces, N_LANDMARK, 3), dtype=np.float32)
+        self.pose = np.zeros((max_faces, 3), dtype=np.float32)
+        self.gender = np.zeros(max_faces, dtype=np.uint8)
+
+    def add_image(self, image):
+        if self.image_ids:
+            self.face_offsets.append(self.num_faces)
+        self.image_ids.append(image['id'])
+        self.paths.append(image['file_name'].encode('utf-8'))
+        self.widths.append(image['width'])
+        self.heights.append(image['height'])
+
+    def add_face(self, face_id, bbox, keypoints, pose, gender, category_id=0):
+        i = self.num_faces
+        self.face_ids[i] = face_id
+        self.boxes[i] = bbox
+        self.category_ids[i] = category_id
+        self.keypoints[i] = keypoints
+        self.pose[i] = pose
+        self.gender[i] = gender
+        self.num_faces += 1
+
+    def save(self, bundle_dir):
+        n = self.num_faces
+        arrays = {
+            'image_ids': np.array(self.image_ids, dtype=np.int64),
+            'path_offsets': np.cumsum([0] + [len(path) for path in self.paths], dtype=np.int64),
+            'paths': np.frombuffer(b''.join(self.paths), dtype=np.uint8),
+            'widths': np.array(self.widths, dtype=np.int32),
+            'heights': np.array(self.heights, dtype=np.int32),
+            'face_offsets': np.array(self.face_offsets + ([n] if self.image_ids else []), dtype=np.int64),
+            'face_ids': self.face_ids[:n],
+            'boxes': self.boxes[:n],
+            'category_ids': self.category_ids[:n],
+            'keypoints': self.keypoints[:n],
+            'pose': self.pose[:n],
+            'gender': self.gender[:n]}
+        if not osp.isdir(bundle_dir):
+            os.makedirs(bundle_dir)
+        for name in BUNDLE_ARRAYS:
+            np.save(osp.join(bundle_dir, '{}.npy'.format(name)), arrays[name])
+        with open(osp.join(bundle_dir, 'meta.json'), 'w') as fp:
+            json.dump({'version': 1,
+                       'num_images': len(self.image_ids),
+                       'num_faces': n,
+                       'arrays': list(BUNDLE_ARRAYS),
+                       'categories': DATASET_CATEGORIES}, fp)
+
+
+def parse_splits(splits):
+    """Parse split specifications of the form `<name>:<ratio>` (e.g., ['train:0.8', 'val:0.1', 'test:0.1']) into a list
+    of (name, ratio) pairs, with ratios normalized to sum to 1."""
+    names, ratios = [], []
+    for split in splits:
+        name, _, ratio = split.partition(':')
+        if not name or not ratio:
+            raise ValueError("Invalid split specification: {} (expected <name>:<ratio>)".format(split))
+        names.append(name)
+        ratios.append(float(ratio))
+    if len(set(names)) != len(names) or min(ratios) < 0 or sum(ratios) <= 0:
+        raise ValueError("Invalid split specifications: {}".format(' '.join(splits)))
+    return [(name, ratio / sum(ratios)) for name, ratio in zip(names, ratios)]
+
+
+def split_images(image_ids, splits, seed=0, strata=None):
+    """Randomly split images into subsets of the given ratios.
+
+    Args:
+        image_ids (list): image ids
+        splits (list): (name, ratio) pairs (see `parse_splits()`)
+        seed (int): random seed
+        strata (list, optional): stratum of each image (e.g., its pose bin); if given, each stratum is split separately
+                                 so that all splits have (about) the same distribution of strata
+
+    Returns:
+        split_image_ids (dict): split name -> list of image ids
+    """
+    rng = np.random.RandomState(seed)
+    strata = np.zeros(len(image_ids), dtype=np.int64) if strata is None else np.asarray(strata)
+    image_ids = np.asarray(image_ids)
+    cum_ratios = np.cumsum([0.] + [ratio for _, ratio in splits])
+    split_image_ids = {name: [] for name, _ in splits}
+    for stratum in np.unique(strata):
+        stratum_image_ids = image_ids[strata == stratum]
+        stratum_image_ids = stratum_image_ids[rng.permutation(len(stratum_image_ids))]
+        bounds = np.round(cum_ratios * len(stratum_image_ids)).astype(np.int64)
+        for (name, _), start, end in zip(splits, bounds[:-1], bounds[1:]):
+            split_image_ids[name] += stratum_image_ids[start:end].tolist()
+    return split_image_ids
+
+
+def shard_images(image_ids, num_faces, num_shards):
+    """Partition images into shards of (about) the same number of faces, by assigning images (in decreasing number of
+    faces order) to the shard with the fewest faces so far.
+
+    Args:
+        image_ids (list): image ids
+        num_faces (dict): image id -> number of faces
+        num_shards (int): number of shards
+
+    Returns:
+        shards (list): list of image ids of each shard
+    """
+    shards = [[] for _ in range(num_shards)]
+    heap = [(0, shard_idx) for shard_idx in range(num_shards)]
+    for image_id in sorted(image_ids, key=lambda i: num_faces[i], reverse=True):
+        shard_faces, shard_idx = heapq.heappop(heap)
+        shards[shard_idx].append(image_id)
+        heapq.heappush(heap, (shard_faces + num_faces[image_id], shard_idx))
+    return shards
+
+
+def get_output_subsets(json_file, split_names=(), num_shards=0):
+    """Get the output json files, i.e., the whole dataset, each split (if any), and the shards of each split (or of the
+    whole dataset, if there are no splits).
+
+    Returns:
+        output_subsets (list): (json file, split name or None, shard index or None) of each output
+    """
+    json_stem, json_ext = osp.splitext(json_file)
+    if get_compression(json_file) is not None:
+        # e.g., aflw.json.gz -> aflw_<split>.json.gz
+        json_stem, ext = osp.splitext(json_stem)
+        json_ext = ext + json_ext
+    output_subsets = [(json_file, None, None)]
+    for split in split_names:
+        output_subsets.append(('{}_{}{}'.format(json_stem, split, json_ext), split, None))
+    if num_shards > 0:
+        for split in split_names or [None]:
+            split_stem = json_stem if split is None else '{}_{}'.format(json_stem, split)
+            for shard_idx in range(num_shards):
+                output_subsets.append(('{}_shard{}of{}{}'.format(split_stem, shard_idx, num_shards, json_ext), split,
+                                       shard_idx))
+    return output_subsets
+
+
+# Images and annotations (grouped by image id), and the output format options (see `save_json()`), shared with the
+# workers writing the output json files; they are set up once per worker (i.e., they are inherited by forked workers),
+# so that only the image ids of each file are sent to them.
+_output_images = None
+_output_annotations = None
+_output_format = None
+
+
+def _init_output_worker(images, annotations, output_format):
+    global _output_images, _output_annotations, _output_format
+    _output_images, _output_annotations, _output_format = images, annotations, output_format
+
+
+def _write_output(json_file, image_ids=None):
+    """Write a COCO json annotation file with the given subset of images (or all images) and their annotations."""
+    images = _output_images if image_ids is None else [_output_images[image_id] for image_id in image_ids]
+    if isinstance(images, dict):
+        images = list(images.values())
+    annotations = [annotation for image in images for annotation in _output_annotations[image['id']]]
 
-def get_img_size(image_filename):
-    im = Image.open(image_filename)
-    return im.size[0], im.size[1]
-
-
-def exec_sqlite_query(cursor, select_str, from_str=None, where_str=None):
-    query_str = 'SELECT {}'.format(select_str)
-    query_str += ' FROM {}'.format(from_str)
-    if where_str:
-        query_str += ' WHERE {}'.format(where_str)
-    return [row for row in cursor.execute(query_str)]
-
-
-def progress_updt(msg, total, progress):
-    bar_length, status = 20, ""
-    progress = float(progress) / float(total)
-    if progress >= 1.:
-        progress, status = 1, "\r\n"
-    block = int(round(bar_length * progress))
-    text = "\r{}[{}] {:.0f}% {}".format(msg, "#" * block + "-" * (bar_length - block), round(progress * 100, 0), status)
-    sys.stdout.write(text)
-    sys.stdout.flush()
+    # Build COCO-like dictionary
+    dataset_dict = dict()
+    dataset_dict.update(DATASET_INFO)
+    dataset_dict.update({'licenses': DATASET_LICENSES})
+    dataset_dict.update({'images': images})
+    dataset_dict.update({'annotations': annotations})
+    dataset_dict.update({'categories': DATASET_CATEGORIES})
+
+    save_json(dataset_dict, json_file, **_output_format)
+
+    return json_file
+
+
+def write_outputs(outputs, images, annotations, workers=4, **output_format):
+    """Write COCO json annotation files in parallel.
+
+    Args:
+        outputs (list): (json file, image ids) pairs, where image ids is None for all images
+        images (dict): image id -> image record (in output order)
+        annotations (dict): image id -> list of annotation records
+        workers (int): number of worker processes (if 0, files are written serially)
+        output_format: output format options, i.e., `compact`, `precision`, and `compression` (see `save_json()`)
+    """
+    if workers > 0 and len(outputs) > 1:
+        with ProcessPoolExecutor(min(workers, len(outputs)), initializer=_init_output_worker,
+                                 initargs=(images, annotations, output_format)) as pool:
+            list(pool.map(_write_output, *zip(*outputs)))
+    else:
+        _init_output_worker(images, annotations, output_format)
+        for json_file, image_ids in outputs:
+            _write_output(json_file, image_ids)
+
+
+def report_image_dedup(json_file, dup_images, repeats=3):
+    """Report how much the json annotation file has shrunk, and how much faster it loads, by emitting each image record
+    once instead of once per face. The json file with duplicates is reconstructed by re-inserting the duplicate image
+    records into its images list.
+
+    Args:
+        json_file (str): COCO json annotation file (with unique image records)
+        dup_images (list): image records that would have been emitted once per (extra) face
+        repeats (int): number of timed loads (the best time is kept)
+    """
+    def time_load(json_str):
+        best = float('inf')
+        for _ in range(repeats):
+            start = time.perf_counter()
+            json.loads(json_str)
+            best = min(best, time.perf_counter() - start)
+        return best
+
+    with open_json(json_file, 'r') as fp:
+        json_str = fp.read()
+    images_start = re.search(r'"images":\s*\[', json_str).end()
+    dup_images_str = ''.join('{}, '.format(json.dumps(image)) for image in dup_images)
+    json_str_dup = json_str[:images_start] + dup_images_str + json_str[images_start:]
+    t_load, t_load_dup = time_load(json_str), time_load(json_str_dup)
+
+    print("  \\__Duplicate image records removed : {}".format(len(dup_images)))
+    print("  \\__Json size                      : {:.2f} MB (instead of {:.2f} MB, {:+.1f}%)".format(
+        len(json_str) / 2 ** 20, len(json_str_dup) / 2 ** 20, 100 * (len(json_str) / len(json_str_dup) - 1)))
+    print("  \\__Json load time                 : {:.1f} ms (instead of {:.1f} ms, {:+.1f}%)".format(
+        1e3 * t_load, 1e3 * t_load_dup, 100 * (t_load / t_load_dup - 1)))
 
 
 def main():
@@ -41,7 +448,59 @@ def main():
     parser.add_argument('-v', '--verbose', action="store_true", help="increase output verbosity")
     parser.add_argument('--dataset_root', type=str, required=True, help='AFLW root directory')
     parser.add_argument('--json', type=str, default='aflw_annotations.json', help="output COCO json annotation file")
+    parser.add_argument('--stream', action='store_true',
+                        help="write images and annotations incrementally as they are read from the database (memory "
+                             "usage does not grow with the size of the dataset)")
+    parser.add_argument('--compact', action='store_true',
+                        help="drop empty fields (e.g., segmentation: [] or flickr_url: '') of image and annotation "
+                             "records, and write no whitespace")
+    parser.add_argument('--precision', type=int,
+                        help="round float values (bounding box and keypoint coordinates) to the given number of "
+                             "decimal digits")
+    parser.add_argument('--compression', type=str, choices=('auto', 'none', 'gzip', 'xz'), default='auto',
+                        help="compress the output json files (by default, based on the extension of --json, i.e., "
+                             ".gz for gzip and .xz for xz)")
+    parser.add_argument('--workers', type=int, default=8,
+                        help="number of workers used for probing image sizes (0 for probing serially)")
+    parser.add_argument('--executor', type=str, choices=('thread', 'process'), default='thread',
+                        help="type of workers used for probing image sizes")
+    parser.add_argument('--probe_backend', type=str, choices=('header', 'pil'), default='header',
+                        help="read image sizes by parsing JPEG/PNG headers (falling back to PIL for other formats) or "
+                             "by using PIL")
+    parser.add_argument('--sqlite_batch_size', type=int, default=4096,
+                        help="number of rows fetched at once from the AFLW database")
+    parser.add_argument('--manifest', type=str, help="conversion manifest file (by default <json>.manifest.json)")
+    parser.add_argument('--no_manifest', action='store_true', help="do not read or write a conversion manifest")
+    parser.add_argument('-f', '--force', action='store_true',
+                        help="convert even if the outputs are up to date according to the conversion manifest")
+    parser.add_argument('--splits', type=str, nargs='+',
+                        help="also write image-level splits of the dataset, given as <name>:<ratio> (e.g., train:0.8 "
+                             "val:0.1 test:0.1), in <json stem>_<name>.json")
+    parser.add_argument('--split_seed', type=int, default=0, help="random seed for splitting the dataset")
+    parser.add_argument('--stratify', type=str, choices=('none', 'pose'), default='none',
+                        help="split each pose bin (mean absolute yaw of the faces of each image) separately")
+    parser.add_argument('--shards', type=int, default=0,
+                        help="also write the dataset (or each split) in N shards of about the same number of faces, in "
+                             "<json stem>[_<split name>]_shard<k>of<N>.json")
+    parser.add_argument('--write_workers', type=int, default=4,
+                        help="number of worker processes used for writing the output json files in parallel (0 for "
+                             "writing them serially)")
+    parser.add_argument('--bundle', type=str,
+                        help="also write a binary columnar annotation bundle (memory-mappable .npy arrays) in the "
+                             "given directory")
+    parser.add_argument('--dedup_report', action='store_true',
+                        help="report how many duplicate image records (one per face) were removed, and how much json "
+                             "size and load time that saved")
+    parser.add_argument('--profile', action='store_true',
+                        help="report wall time, CPU time, throughput, and peak RSS of each conversion stage")
+    parser.add_argument('--profile_json', type=str, help="also save the profile report in the given json file")
     args = parser.parse_args()
+    try:
+        splits = parse_splits(args.splits) if args.splits else []
+    except ValueError as e:
+        parser.error(str(e))
+    if args.stream and (splits or args.shards > 0):
+        parser.error("--splits and --shards cannot be used along with --stream")
 
     # Get absolute path of dataset root dir
     args.dataset_root = osp.abspath(args.dataset_root)
@@ -49,15 +508,80 @@ def main():
     if args.verbose:
         print("#. Transform AFLW annotations into COCO json format...")
 
+    # Conversion stages profile
+    profiler = StageProfiler()
+
+    def report_profile():
+        if args.profile or args.profile_json:
+            print("#. Conversion profile:")
+            profiler.print_summary()
+        if args.profile_json:
+            profiler.save(args.profile_json, args=vars(args))
+
+    # Load the manifest of the previous conversion (if any), which records the state of the database and the image files
+    # that the previous outputs were built from, as well as the probed image sizes.
+    sqlite_file = osp.join(args.dataset_root, 'aflw.sqlite')
+    manifest_file = args.manifest or '{}.manifest.json'.format(args.json)
+    manifest = None if args.no_manifest else load_manifest(manifest_file)
+    sqlite_fingerprint = file_fingerprint(sqlite_file, manifest['sqlite'] if manifest else None)
+    output_options = {'probe_backend': args.probe_backend,
+                      'splits': [list(split) for split in splits],
+                      'split_seed': args.split_seed,
+                      'stratify': args.stratify,
+                      'shards': args.shards,
+                      'bundle': args.bundle,
+                      'compact': args.compact,
+                      'precision': args.precision,
+                      'compression': args.compression}
+
+    output_subsets = get_output_subsets(args.json, [name for name, _ in splits], args.shards)
+    output_files = [json_file for json_file, _, _ in output_subsets]
+    if args.bundle:
+        output_files += [osp.join(args.bundle, '{}.npy'.format(name)) for name in BUNDLE_ARRAYS] + \
+            [osp.join(args.bundle, 'meta.json')]
+    probe_cache = dict()
+    probed = dict()
+    if manifest is not None:
+        probe_cache = {osp.join(args.dataset_root, img_path): probe_res
+                       for img_path, probe_res in manifest['images'].items()}
+
+    # Skip conversion if neither the database, nor any of the image files, nor the outputs have changed since the
+    # previous conversion (images have to be re-stat'ed, but not re-probed).
+    if manifest is not None and not args.force \
+            and manifest['sqlite']['sha256'] == sqlite_fingerprint['sha256'] \
+            and manifest['options'] == output_options \
+            and all(file_stat(output_file) == manifest['outputs'].get(output_file) for output_file in output_files):
+        if args.verbose:
+            print("  \\__Check image files against the conversion manifest...", end="")
+            sys.stdout.flush()
+        profiler.start('manifest_check')
+        img_paths = list(probe_cache.keys())
+        probed = probe_images(img_paths, cache=probe_cache, workers=args.workers, executor=args.executor,
+                              backend=args.probe_backend)
+        profiler.stop(items=len(img_paths), unit='files')
+        if all(probed[img_path] == probe_cache[img_path] for img_path in img_paths):
+            if args.verbose:
+                print("Done!")
+                print("  \\__Outputs are up to date (use --force to convert anyway)")
+            report_profile()
+            return
+        if args.verbose:
+            print("Done!")
+
     # Open the original AFLW annotation (sqlite database)
     if args.verbose:
         print("  \\__Open the AFLW SQLight database...", end="")
         sys.stdout.flush()
 
-    conn = sqlite3.connect(osp.join(args.dataset_root, 'aflw.sqlite'))
-    cursor = conn.cursor()
+    # Opening the database and counting the faces and images of the join; the join itself is run lazily, as its rows
+    # are read, i.e., it is timed along with the `coco_assembly` stage
+    profiler.start('sql_count')
+    db = AFLWDatabase(sqlite_file, batch_size=args.sqlite_batch_size)
     if args.verbose:
         print("Done!")
+        if db.created_indexes:
+            print("  \\__Create missing indexes (in a temporary copy of the database): {}".format(
+                ", ".join("{}.{}".format(table, column) for table, column in db.created_indexes)))
 
     # Build sqlite queries
     select_str = "faces.face_id, " \
@@ -79,15 +603,15 @@ def main():
                 "faces.face_id = rect.face_id and " \
                 "faces.face_id = pose.face_id and " \
                 "faces.face_id = metadata.face_id"
-    query_res = exec_sqlite_query(cursor, select_str, from_str, where_str)
+
+    # Faces are grouped by image, so that each image record is emitted once (i.e., along with its first face)
+    order_by_str = "imgs.filepath, faces.face_id"
 
     # Count total number of images in AFLW dataset
     if args.verbose:
         print("  \\__Count total number of images in AFLW database: ", end="")
         sys.stdout.flush()
-    total_num_images = 0
-    for _ in query_res:
-        total_num_images += 1
+    total_num_images = db.count(from_str, where_str)
     if args.verbose:
         print(total_num_images)
 
@@ -98,192 +622,228 @@ def main():
     except OSError:
         pass
 
-    # Temporary dataset variables
-    aflw_dataset_dict = dict()
+    # Probe the size of each image referenced by the dataset exactly once (multiple faces may share the same image)
+    img_paths = [osp.join(args.dataset_root, 'flickr', path) for (path,) in
+                 db.query("DISTINCT imgs.filepath", from_str, where_str)]
+    profiler.stop(items=total_num_images, unit='rows')
+    if args.verbose:
+        print("  \\__Count total number of unique images in AFLW database: {}".format(len(img_paths)))
+
+    profiler.start('image_probing')
+    probe_progress = None
+    if args.verbose and img_paths:
+        probe_progress = ProgressReporter("  \\__Probe image sizes...", len(img_paths), name='image_probing',
+                                          unit='files')
+    probed = probe_images(img_paths, cache=dict(probe_cache, **probed) if probed else probe_cache,
+                          workers=args.workers, executor=args.executor, backend=args.probe_backend,
+                          callback=probe_progress.update if probe_progress is not None else None)
+    profiler.stop(items=len(img_paths), unit='files')
+    if args.verbose:
+        print("  \\__Number of images probed: {} (reused from the conversion manifest: {})".format(
+            len(img_paths), sum(probe_res is not None and probe_res == probe_cache.get(img_path)
+                                for img_path, probe_res in probed.items())))
+
+    # If an image file does not exist append its filepath to `not_found_images_file`; its faces are skipped.
+    not_found_img_paths = [img_path for img_path in img_paths if probed[img_path] is None]
+    if not_found_img_paths:
+        with open(not_found_images_file, "w") as out:
+            out.writelines("%s\n" % img_path for img_path in not_found_img_paths)
+
+    # Landmark property: all landmark rows are scattered at once into a keypoints block indexed by the position of
+    # each face in the (ordered) list of face ids.
+    if args.verbose:
+        print("  \\__Build AFLW keypoints...", end="")
+        sys.stdout.flush()
+    profiler.start('landmark_fill')
+    num_rows = db.num_rows
+    face_ids = np.fromiter((face_id for (face_id,) in db.query("faces.face_id", from_str, where_str,
+                                                                order_by_str=order_by_str)),
+                           dtype=np.int64, count=total_num_images)
+    keypoints, invalid_face_ids = build_keypoints(face_ids,
+                                                  db.query(select_str="faces.face_id, coords.feature_id, "
+                                                                      "coords.x, coords.y",
+                                                           from_str="faces, featurecoords coords",
+                                                           where_str="faces.face_id = coords.face_id"))
+    profiler.stop(items=db.num_rows - num_rows, unit='rows')
+    if args.verbose:
+        print("Done!")
+
+    # Face rows are ordered as face ids, so that the i-th face row corresponds to face_ids[i]
+    profiler.start('coco_assembly')
+    query_res = db.query(select_str, from_str, where_str, order_by_str=order_by_str)
 
-    # Register to dataset_dict
+    # Images and annotations are either written straight to the output file (streaming mode) or collected in memory
+    # and dumped at once after the conversion.
+    if args.stream:
+        writer = COCOStreamWriter(args.json,
+                                  header=dict(DATASET_INFO, licenses=DATASET_LICENSES),
+                                  footer={'categories': DATASET_CATEGORIES},
+                                  compact=args.compact, precision=args.precision, compression=args.compression)
+        add_image, add_annotation = writer.add_image, writer.add_annotation
+    else:
+        images = dict()
+        annotations = dict()
+
+        def add_image(image):
+            images[image['id']] = image
+            annotations[image['id']] = []
+
+        def add_annotation(annotation):
+            annotations[annotation['image_id']].append(annotation)
+
+    # Binary columnar annotation bundle
+    bundle_writer = AnnotationBundleWriter(max_faces=total_num_images) if args.bundle else None
+
+    # Mean absolute yaw (in degrees) of the faces of each image, used for stratified splits
+    image_yaws = dict()
+
+    # Convert to COCO format
     img_cnt = 0
-    for face_id, path, rectx, recty, rectw, recth, roll, pitch, yaw, gender in query_res:
+    # Image path of each image id; faces are grouped by image id, and image paths that are mapped to the same id (see
+    # `get_image_id()`) are rejected, instead of the faces of one of them being dropped
+    image_paths = dict()
+    dup_images = []
+    convert_progress = None
+    if args.verbose and total_num_images:
+        convert_progress = ProgressReporter("  \\__Convert to COCO format...", total_num_images, name='coco_assembly',
+                                            unit='rows')
+    for face_idx, (face_id, path, rectx, recty, rectw, recth, roll, pitch, yaw, gender) in enumerate(query_res):
 
         img_cnt += 1
 
+        # Show progress bar
+        if convert_progress is not None:
+            convert_progress.update(img_cnt)
+
         # Get current image path
         img_path = osp.join(args.dataset_root, 'flickr', path)
 
         # Process current image
-        if osp.isfile(img_path):
-            img_w, img_h = get_img_size(img_path)
-
-            keypoints = N_LANDMARK * 3 * [0]
-            pose = [roll, pitch, yaw]
-            gender = 0 if gender == 'm' else 1
-
-            # Register
-            aflw_dataset_dict[face_id] = {
-                'face_id': face_id,
-                'img_path': osp.join('flickr', path),
-                'width': img_w,
-                'height': img_h,
-                'bbox': (rectx, recty, rectw, recth),
-                'keypoints': keypoints,
-                'pose': pose,
-                'gender': gender}
-
-        # If current image file does not exist append the not found images filepaths to `not_found_images_file` and
-        # continue with the next image file.
+        probe_res = probed.get(img_path)
+        if probe_res is not None:
+            img_w, img_h = probe_res[2:]
+            image_id = get_image_id(osp.join('flickr', path))
+
+            image = {'id': image_id,
+                     'file_name': osp.join('flickr', path),
+                     'height': img_h,
+                     'width': img_w,
+                     'date_captured': '',
+                     'flickr_url': '',
+                     'license': 1,
+                     'dataset': 'aflw'}
+            if image_id not in image_paths:
+                add_image(image)
+                if bundle_writer is not None:
+                    bundle_writer.add_image(image)
+                image_paths[image_id] = path
+            elif image_paths[image_id] != path:
+                raise RuntimeError("Images {} and {} have the same image id: {}".format(
+                    osp.join('flickr', image_paths[image_id]), osp.join('flickr', path), image_id))
+            elif args.dedup_report:
+                dup_images.append(image)
+
+            add_annotation({'id': face_id,
+                            'image_id': image_id,
+                            'segmentation': [],
+                            'num_keypoints': 3 * N_LANDMARK,
+                            'area': 0,
+                            'iscrowd': 0,
+                            'keypoints': keypoints_to_list(keypoints[face_idx]),
+                            'bbox': (rectx, recty, rectw, recth),
+                            'category_id': 0})
+            if bundle_writer is not None:
+                bundle_writer.add_face(face_id, bbox=(rectx, recty, rectw, recth), keypoints=keypoints[face_idx],
+                                       pose=(roll, pitch, yaw), gender=0 if gender == 'm' else 1)
+            if args.stratify == 'pose':
+                image_yaws.setdefault(image_id, []).append(abs(np.degrees(yaw)))
+
+        # If current image file does not exist continue with the next face.
         else:
-            with open(not_found_images_file, "a") as out:
-                out.write("%s\n" % img_path)
+            if keypoints[face_idx, :, 2].any():
+                invalid_face_ids.add(face_id)
             continue
 
-        # Show progress bar
-        if args.verbose:
-            progress_updt("  \\__Populate AFLW dataset dictionary...", total_num_images, img_cnt)
+    if convert_progress is not None:
+        convert_progress.close()
+    profiler.stop(items=img_cnt, unit='rows')
+    profiler.count('missing_images', len(not_found_img_paths))
+    profiler.count('unregistered_faces', len(invalid_face_ids))
 
     if args.verbose:
-        print("  \\__Update AFLW dataset dictionary with keypoints...", end="")
-        sys.stdout.flush()
-
-    # Landmark property
-    # (Visibility is expressed by lack of the coordinate's row.)
-    select_str = "faces.face_id, coords.feature_id, coords.x, coords.y"
-    from_str = "faces, featurecoords coords"
-    where_str = "faces.face_id = coords.face_id"
-    query_res = exec_sqlite_query(cursor, select_str, from_str, where_str)
-
-    # Register to dataset_dict
-    invalid_face_ids = list()
-    for face_id, feature_id, x, y in query_res:
-        assert (1 <= feature_id <= N_LANDMARK)
-        if face_id in aflw_dataset_dict:
-            idx = feature_id - 1
-            aflw_dataset_dict[face_id]['keypoints'][3 * idx] = x
-            aflw_dataset_dict[face_id]['keypoints'][3 * idx + 1] = y
-            aflw_dataset_dict[face_id]['keypoints'][3 * idx + 2] = 1
-
-        elif face_id not in invalid_face_ids:
-            invalid_face_ids.append(face_id)
-
-    if args.verbose:
-        print("Done!")
+        print("  \\__Number of faces with landmarks that are not registered: {}".format(len(invalid_face_ids)))
 
     # Close database
     if args.verbose:
         print("  \\__Close the AFLW SQLight database...", end="")
         sys.stdout.flush()
-    cursor.close()
+    db.close()
     if args.verbose:
         print("Done!")
 
-    # Close database
+    # Save dataset dictionary as json file
     if args.verbose:
-        print("  \\__Convert to COCO format...", end="")
+        print("  \\__Save dataset dictionary as json file...", end="")
         sys.stdout.flush()
 
-    images_list = []
-    annotations_list = []
-    for face_id, face_ann in aflw_dataset_dict.items():
-        img_dir_num = int(face_ann['img_path'].split("/")[1])
-        img_file_num = int(re.findall(r'\d+', face_ann['img_path'].split("/")[-1].split(".")[0])[0])
-        image_id = int("%d%05d" % (img_dir_num, img_file_num))
-
-        images_list.append({'id': image_id,
-                            'file_name': face_ann['img_path'],
-                            'height': face_ann['height'],
-                            'width': face_ann['width'],
-                            'date_captured': '',
-                            'flickr_url': '',
-                            'license': 1,
-                            'dataset': 'aflw'})
-
-        annotations_list.append({'id': face_id,
-                                 'image_id': image_id,
-                                 'segmentation': [],
-                                 'num_keypoints': len(face_ann['keypoints']),
-                                 'area': 0,
-                                 'iscrowd': 0,
-                                 'keypoints': face_ann['keypoints'],
-                                 'bbox': face_ann['bbox'],
-                                 'category_id': 0})
-
-    # Build COCO-like dictionary
-    dataset_dict = dict()
-
-    # =============================== Dataset Info =============================== #
-    dataset_info = {
-        'description': 'Annotated Facial Landmarks in the Wild (AFLW)',
-        'url': 'https://www.tugraz.at/institute/icg/research/team-bischof/lrs/downloads/aflw/',
-        'version': '1.0',
-        'year': 2011,
-        'contributor': '',
-        'date_created': '2011'
-    }
-    dataset_dict.update(dataset_info)
-
-    # ============================= Dataset Licenses ============================= #
-    dataset_licenses = {
-        'licenses': [
-            {'id': 0,
-             'url': 'https://www.tugraz.at/institute/icg/research/team-bischof/lrs/downloads/aflw/',
-             'name': 'aflw_license'}
-        ]
-    }
-    dataset_dict.update(dataset_licenses)
-
-    # ============================== Dataset Images ============================== #
-    dataset_images = {'images': images_list}
-    dataset_dict.update(dataset_images)
-
-    # =========================== Dataset Annotations ============================ #
-    dataset_annotations = {'annotations': annotations_list}
-    dataset_dict.update(dataset_annotations)
-
-    # ============================ Dataset Categories ============================ #
-    dataset_categories = {
-        'categories':
-            [
-                {'supercategory': 'face',
-                 'name': 'face',
-                 'skeleton': [],
-                 'keypoints': ['LeftBrowLeftCorner',
-                               'LeftBrowCenter',
-                               'LeftBrowRightCorner',
-                               'RightBrowLeftCorner',
-                               'RightBrowCenter',
-                               'RightBrowRightCorner',
-                               'LeftEyeLeftCorner',
-                               'LeftEyeCenter',
-                               'LeftEyeRightCorner',
-                               'RightEyeLeftCorner',
-                               'RightEyeCenter',
-                               'RightEyeRightCorner',
-                               'LeftEar',
-                               'NoseLeft',
-                               'NoseCenter',
-                               'NoseRight',
-                               'RightEar',
-                               'MouthLeftCorner',
-                               'MouthCenter',
-                               'MouthRightCorner',
-                               'ChinCenter'],
-                 'id': 0}
-            ]
-    }
-    dataset_dict.update(dataset_categories)
+    profiler.start('json_write')
+    if args.stream:
+        writer.close()
+    else:
+        # Split (image-level) and shard the dataset
+        split_image_ids = dict()
+        if splits:
+            strata = None
+            if args.stratify == 'pose':
+                strata = np.digitize([np.mean(image_yaws[image_id]) for image_id in images], POSE_BIN_EDGES)
+            split_image_ids = split_images(list(images), splits, seed=args.split_seed, strata=strata)
+        shards = dict()
+        outputs = []
+        for json_file, split, shard_idx in output_subsets:
+            subset_image_ids = split_image_ids[split] if split is not None else None
+            if shard_idx is not None:
+                if split not in shards:
+                    subset_image_ids = subset_image_ids if split is not None else list(images)
+                    shards[split] = shard_images(subset_image_ids, {image_id: len(annotations[image_id])
+                                                                    for image_id in subset_image_ids}, args.shards)
+                subset_image_ids = shards[split][shard_idx]
+            outputs.append((json_file, subset_image_ids))
+        write_outputs(outputs, images, annotations, workers=args.write_workers,
+                      compact=args.compact, precision=args.precision, compression=args.compression)
 
     if args.verbose:
         print("Done!")
+        if len(output_subsets) > 1:
+            for json_file, _, _ in output_subsets:
+                print("  \\__{}".format(json_file))
 
-    # Save dataset dictionary as json file
-    if args.verbose:
-        print("  \\__Save dataset dictionary as json file...", end="")
-        sys.stdout.flush()
+    if bundle_writer is not None:
+        if args.verbose:
+            print("  \\__Save binary annotation bundle...", end="")
+            sys.stdout.flush()
+        bundle_writer.save(args.bundle)
+        if args.verbose:
+            print("Done!")
+    profiler.stop(items=len(output_files), unit='files')
 
-    with open(args.json, 'w') as fp:
-        json.dump(dataset_dict, fp)
+    if args.dedup_report:
+        print("#. Report duplicate image records...")
+        report_image_dedup(args.json, dup_images)
 
-    if args.verbose:
-        print("Done!")
+    # Save the conversion manifest
+    if not args.no_manifest:
+        if args.verbose:
+            print("  \\__Save conversion manifest...", end="")
+            sys.stdout.flush()
+        save_manifest(manifest_file, {
+            'sqlite': sqlite_fingerprint,
+            'options': output_options,
+            'outputs': {output_file: file_stat(output_file) for output_file in output_files},
+            'images': {osp.relpath(img_path, args.dataset_root): probe_res for img_path, probe_res in probed.items()}})
+        if args.verbose:
+            print("Done!")
+
+    report_profile()
 
 
 if __name__ == "__main__":
@@ -1,6 +1,10 @@
-from .aflw import AFLW, AFLWAnnotationTransform
+from .aflw import AFLW, AFLWAnnotationTransform, AFLWBatch
+from .faces import AFLWFaces
 from .augmentations import Augmentor
-from .collation import detection_collate
+from .collation import detection_collate, DetectionCollator
+from .bundle import load_bundle, save_bundle
+from .cache import DecodedImageCache
+from .prefetch import ReadAheadPrefetcher, ReadAheadSampler
 import numpy as np
 import cv2
 
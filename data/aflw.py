@@ -1,34 +1,74 @@
+import os
 import os.path as osp
 import sys
+from concurrent.futures import ThreadPoolExecutor
 import torch
 import torch.utils.data as data
 import cv2
 import numpy as np
+from .json_io import load_json
+from .bundle import load_bundle
+from .cache import DecodedImageCache
+from .prefetch import ReadAheadPrefetcher
+from .shards import ImageShards
+from .store import AnnotationStore
+
+
+# Image decoding flags; the EXIF orientation of images is ignored, as their annotations (i.e., width, height, and
+# coordinates) are the ones of the stored (i.e., not rotated) image
+IMREAD_FLAGS = cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION
+
+# Reduced-resolution decoding flags (JPEG images are downscaled in the DCT domain while decoding), by scale factor
+IMREAD_REDUCED_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8 | cv2.IMREAD_IGNORE_ORIENTATION),
+                        (4, cv2.IMREAD_REDUCED_COLOR_4 | cv2.IMREAD_IGNORE_ORIENTATION),
+                        (2, cv2.IMREAD_REDUCED_COLOR_2 | cv2.IMREAD_IGNORE_ORIENTATION))
+
+
+def get_imread_flags(height, width, target_size=None):
+    """Get the flags for decoding an image of the given size at the lowest resolution (i.e., 1/8, 1/4, or 1/2 of the
+    full one) whose height and width are still at least `target_size`, or at full resolution (if `target_size` is
+    None), ignoring its EXIF orientation (see `IMREAD_FLAGS`)."""
+    if target_size:
+        for factor, flags in IMREAD_REDUCED_FLAGS:
+            if min(height, width) >= factor * target_size:
+                return flags
+    return IMREAD_FLAGS
 
 
 class AFLWAnnotationTransform(object):
-    """Transforms an AFLW annotation entry into a Tensor of bbox coords and label index."""
+    """Transforms an AFLW annotation entry into a Tensor of bbox coords and label index.
+
+    Note: `AFLW` does not call this (default) target transform per sample; the same targets are computed for all images
+    at once when the annotation index is built (see `data.index.build_targets()`).
+    """
     def __init__(self):
         pass
 
     def __call__(self, target, width, height):
         """
         Args:
-            target (dict): AFLW target json annotation as a python dict
+            target (np.ndarray or list): AFLW target annotations, i.e., an array of [x, y, width, height, category id]
+                                         rows (see `AnnotationStore.annotations()`), or a list of json annotations as
+                                         python dicts
             height (int): height
             width (int): width
         Returns:
-            a list containing lists of bounding boxes  [bbox coords, class idx]
+            an array (or a list) containing bounding boxes  [bbox coords, class idx]
         """
-        res = []
         scale = np.array([width, height, width, height])
+        if isinstance(target, np.ndarray):
+            res = np.empty((len(target), 5))
+            res[:, :2] = target[:, :2]
+            res[:, 2:4] = target[:, :2] + target[:, 2:4]
+            res[:, :4] /= scale
+            res[:, 4] = target[:, 4]
+            return res
+        res = []
         for obj in target:
-            # Get bounding box
+            # Get bounding box (without modifying the annotation)
             if 'bbox' in obj:
-                bbox = obj['bbox']
-                bbox[2] += bbox[0]
-                bbox[3] += bbox[1]
-                bbox_list = list(np.array(bbox) / scale)
+                x, y, w, h = obj['bbox']
+                bbox_list = list(np.array([x, y, x + w, y + h]) / scale)
                 # Get label idx
                 label_idx = obj['category_id']
                 bbox_list.append(label_idx)
@@ -38,26 +78,120 @@ class AFLWAnnotationTransform(object):
         return res
 
 
+class AFLWBatch(list):
+    """Batch of (image, target) samples, as returned by `AFLW.__getitems__()`, along with all images stacked into a
+    single (B, C, H, W) tensor (`images`), of which the images of the samples are views, or None if images differ in
+    size (e.g., without a resizing transform).
+
+    Args:
+        imgs (list): (H, W, C) images (np.ndarray)
+        targets (list): targets of the images
+    """
+    def __init__(self, imgs, targets):
+        self.images = None
+        if imgs and all(img.shape == imgs[0].shape for img in imgs):
+            height, width, channels = imgs[0].shape
+            self.images = torch.empty((len(imgs), channels, height, width), dtype=torch.from_numpy(imgs[0]).dtype)
+            for image, img in zip(self.images, imgs):
+                image.copy_(torch.from_numpy(img).permute(2, 0, 1))
+            images = list(self.images)
+        else:
+            images = [torch.from_numpy(img).permute(2, 0, 1) for img in imgs]
+        super(AFLWBatch, self).__init__(zip(images, targets))
+
+
 class AFLW(data.Dataset):
     """AFLW Dataset.
     Args:
         root (string): Root directory where images have been downloaded to.
+        json (string): COCO json annotation file (relative to root); it may be compact and/or compressed (gzip or xz).
         transform (callable, optional): A function/transform that augments the raw images.
         target_transform (callable, optional): A function/transform that takes in the target (bbox) and transforms it.
+        index_cache_dir (string, optional): Directory where the annotation index is cached (see `data.index`).
+        image_cache_mb (int, optional): Size (in MB) of the (per-process) cache of decoded images (see
+                                        `data.cache.DecodedImageCache`); by default, images are decoded on every access.
+        packed (string, optional): Directory of images packed by `pack_dataset.py`: for `resized` packs, images
+                                   (resized to a fixed size) and their (rescaled) targets are read from its memory-
+                                   mapped arrays, with no decoding or resizing, and `target_transform` is not used; for
+                                   `shards` packs, images are decoded from the memory-mapped shard files, instead of
+                                   being read file by file.
+        target_size (int, optional): Size that images are resized to by `transform` (e.g., 300); if given, images are
+                                     decoded at the lowest resolution (1/2, 1/4, or 1/8) that is still at least
+                                     `target_size` x `target_size` (see `get_imread_flags()`).
+        read_ahead (int, optional): Number of images whose (encoded) bytes are read ahead by a background thread pool,
+                                    in the order given to `prefetcher` (see `data.prefetch.ReadAheadPrefetcher` and
+                                    `data.prefetch.ReadAheadSampler`); by default, images are read when decoded.
+                                    Read-ahead only takes place with a DataLoader with `num_workers=0`: in DataLoader
+                                    workers, it has no effect (other than a warning).
+        read_ahead_mb (int, optional): Maximum size (in MB) of the images read ahead and not decoded yet.
+        batch_threads (int, optional): Number of threads decoding (and transforming) the images of a batch (see
+                                       `__getitems__()`).
     """
     def __init__(self,
                  root,
                  json='aflw_annotations.json',
                  transform=None,
-                 target_transform=AFLWAnnotationTransform()):
-        sys.path.append(osp.join(root, "PythonAPI"))
-        from pycocotools.coco import COCO
+                 target_transform=AFLWAnnotationTransform(),
+                 index_cache_dir=None,
+                 image_cache_mb=0,
+                 packed=None,
+                 target_size=None,
+                 read_ahead=0,
+                 read_ahead_mb=256,
+                 batch_threads=4):
         self.root = root
         self.json = json
-        self.coco = COCO(osp.join(self.root, self.json))
-        self.ids = list(self.coco.imgToAnns.keys())
+        # Image paths, sizes, and bounding boxes are read from an array-backed store built from a (cached) compact index
+        # of the annotation file, instead of a pycocotools COCO object (see `coco`)
+        self.store = AnnotationStore.from_json(osp.join(self.root, self.json), cache_dir=index_cache_dir)
+        self.ids = self.store.image_ids
         self.transform = transform
         self.target_transform = target_transform
+        self.target_size = target_size
+        self.image_cache = DecodedImageCache(image_cache_mb * 2 ** 20) if image_cache_mb > 0 else None
+        self.prefetcher = ReadAheadPrefetcher(self.read_bytes, read_ahead, max_bytes=read_ahead_mb * 2 ** 20,
+                                              size=self.image_nbytes) if read_ahead > 0 else None
+        self.batch_threads = batch_threads
+        self._batch_executor = None
+        self._batch_pid = None
+        self._coco = None
+        self.packed = None
+        self.shards = None
+        if packed is not None:
+            arrays, meta = load_bundle(packed)
+            if meta.get('kind') not in ('resized', 'shards') or not np.array_equal(arrays['image_ids'], self.ids):
+                raise RuntimeError("Packed images do not match annotation file {} (re-run pack_dataset.py): {}".format(
+                    self.json, packed))
+            if meta['kind'] == 'resized':
+                self.packed = arrays
+            else:
+                self.shards = ImageShards(packed)
+
+    def __getstate__(self):
+        # The batch thread pool is not inherited by other processes (e.g., DataLoader workers)
+        state = self.__dict__.copy()
+        state['_batch_executor'] = None
+        return state
+
+    @property
+    def coco(self):
+        """pycocotools COCO object of the annotation file, built on first access (e.g., for COCO-style evaluation)."""
+        if self._coco is None:
+            sys.path.append(osp.join(self.root, "PythonAPI"))
+            from pycocotools.coco import COCO
+            # Load the (possibly compressed) annotation file and index it as `COCO(annotation_file)` would
+            self._coco = COCO()
+            self._coco.dataset = load_json(osp.join(self.root, self.json))
+            self._coco.createIndex()
+        return self._coco
+
+    def load_anns(self, index):
+        """Get the annotations (i.e., bounding box and category id) of the index-th image from the annotation store, in
+        the form returned by `coco.loadAnns()`."""
+        ann_slice = self.store.annotation_slice(index)
+        return [{'id': int(ann_id), 'bbox': bbox, 'category_id': int(label)}
+                for ann_id, bbox, label in zip(self.store.ann_ids[ann_slice], self.store.boxes[ann_slice].tolist(),
+                                               self.store.labels[ann_slice])]
 
     def __getitem__(self, index):
         """
@@ -70,6 +204,34 @@ class AFLW(data.Dataset):
         im, bbox_gt, h, w, img_id, img_path = self.pull_item(index)
         return im, bbox_gt
 
+    def __getitems__(self, indices):
+        """Get a batch of samples at once (used by DataLoader, instead of calling `__getitem__()` for each index).
+
+        The sizes and annotation slices of all images are read from the annotation store at once, and the images are
+        decoded and transformed by a pool of `batch_threads` threads (OpenCV releases the GIL while decoding and
+        resizing).
+
+        Args:
+            indices (list): Indices
+        Returns:
+            AFLWBatch: list of (image, target) tuples, as returned by `__getitem__()`, with their images stacked.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        heights, widths = self.store.heights[indices].tolist(), self.store.widths[indices].tolist()
+        starts, ends = self.store.box_offsets[indices].tolist(), self.store.box_offsets[indices + 1].tolist()
+        items = [(index, height, width, slice(start, end))
+                 for index, height, width, start, end in zip(indices.tolist(), heights, widths, starts, ends)]
+        if self.batch_threads > 1 and len(items) > 1:
+            # A forked process (e.g., a DataLoader worker) inherits the thread pool, but not its threads, so each
+            # process creates its own
+            if self._batch_executor is None or self._batch_pid != os.getpid():
+                self._batch_executor = ThreadPoolExecutor(self.batch_threads)
+                self._batch_pid = os.getpid()
+            samples = list(self._batch_executor.map(lambda item: self.load_sample(*item), items))
+        else:
+            samples = [self.load_sample(*item) for item in items]
+        return AFLWBatch([img for img, _ in samples], [target for _, target in samples])
+
     def __len__(self):
         return len(self.ids)
 
@@ -79,27 +241,59 @@ class AFLW(data.Dataset):
             index (int): Index
         Returns:
             tuple: Tuple (image, target, height, width).
-                   target is the object returned by ``coco.loadAnns``.
+                   target is an array of [x, y, width, height, category id] rows (see `AnnotationStore.annotations()`).
         """
-        img_id = self.ids[index]
-        ann_ids = self.coco.getAnnIds(imgIds=img_id)
-        target = self.coco.loadAnns(ann_ids)
-        path = osp.join(self.root, self.coco.loadImgs(img_id)[0]['file_name'])
-        assert osp.exists(path), 'Image path does not exist: {}'.format(path)
-        img = cv2.imread(path)
-        height, width, _ = img.shape
-
-        if self.target_transform is not None:
-            target = self.target_transform(target, width, height)
-
-        target = np.array(target)
+        height, width = self.store.image_size(index)
+        img, bbox_target = self.load_sample(index, height, width, self.store.annotation_slice(index))
+        return torch.from_numpy(img).permute(2, 0, 1), bbox_target, height, width, self.store.image_id(index), \
+            osp.join(self.root, self.store.image_path(index))
+
+    def load_sample(self, index, height, width, ann_slice):
+        """Decode the index-th image and get its target, and apply `transform` to them, given the height and width of
+        the image (as annotated) and the slice of its annotations in the annotation store.
+
+        Returns:
+            tuple: Tuple (image, target), where image is an (H, W, C) np.ndarray.
+        """
+        if self.packed is not None:
+            # Pre-resized image (copied out of the memory-mapped array) and rescaled targets; height and width are the
+            # ones of the original image
+            if not self.packed['valid'][index]:
+                raise RuntimeError("Image could not be read when packing: {}".format(self.store.image_path(index)))
+            img = np.array(self.packed['images'][index])
+            target = self.packed['targets'][ann_slice]
+        else:
+            # Images may be decoded at a reduced resolution (see `target_size`), so height and width are the ones of the
+            # original image (as annotated), and targets are normalized by them
+            img = self.read_image(index, reduced=True)
+            if type(self.target_transform) is AFLWAnnotationTransform:
+                # Precomputed (normalized) targets
+                target = self.store.targets[ann_slice]
+            elif self.target_transform is not None:
+                # Custom target transforms are given the json annotations, as returned by `coco.loadAnns()`
+                target = np.asarray(self.target_transform(self.load_anns(index), width, height))
+            else:
+                target = self.store.annotations(index)
+
         if self.transform is not None:
-            img, boxes, labels = self.transform(img=img, boxes=target[:, :4], labels=target[:, -1])
+            # Transforms may modify boxes in place, so they are given copies
+            img, boxes, labels = self.transform(img=img, boxes=target[:, :4].copy(), labels=target[:, -1].copy())
+            bbox_target = np.hstack((boxes, np.expand_dims(labels, axis=1)))
         else:
-            boxes, labels = target[:, :4], target[:, -1]
-        bbox_target = np.hstack((boxes, np.expand_dims(labels, axis=1)))
+            bbox_target = np.array(target)
 
-        return torch.from_numpy(img).permute(2, 0, 1), bbox_target, height, width, img_id, path
+        return img, bbox_target
+
+    def pull_keypoints(self, index):
+        """
+        Args:
+            index (int): Index
+        Returns:
+            (N, K, 3) array of the [x, y, visibility] keypoints of each face of the image (in the same order as its
+            targets), normalized by the image size, or None if the annotation file has no keypoints.
+        """
+        keypoints = self.store.get_keypoints(index)
+        return None if keypoints is None else keypoints.copy()
 
     def pull_image(self, index):
         """ Returns the original image object at index in PIL form
@@ -111,9 +305,51 @@ class AFLW(data.Dataset):
         Return:
             cv2 img
         """
-        img_id = self.ids[index]
-        path = self.coco.loadImgs(img_id)[0]['file_name']
-        return cv2.imread(osp.join(self.root, path), cv2.IMREAD_COLOR)
+        return self.read_image(index)
+
+    def read_image(self, index, reduced=False):
+        """Decode the index-th image (BGR), from its file or its image shard (if any), or get it from the decoded image
+        cache (if any). With `reduced`, the image is decoded at a reduced resolution according to `target_size`."""
+        flags = get_imread_flags(*self.store.image_size(index), self.target_size) if reduced else IMREAD_FLAGS
+
+        def decode():
+            if self.prefetcher is not None:
+                buf = self.prefetcher.get(index)
+                assert buf is not None, 'Image could not be read: {}'.format(self.store.image_path(index))
+                return cv2.imdecode(np.frombuffer(buf, dtype=np.uint8), flags)
+            if self.shards is not None:
+                img = self.shards.decode(index, flags)
+                assert img is not None, 'Image was not packed: {}'.format(self.store.image_path(index))
+                return img
+            path = osp.join(self.root, self.store.image_path(index))
+            assert osp.exists(path), 'Image path does not exist: {}'.format(path)
+            return cv2.imread(path, flags)
+
+        if self.image_cache is None:
+            return decode()
+        return self.image_cache.get((index, flags), decode)
+
+    def read_bytes(self, index):
+        """Read the encoded bytes of the index-th image, from its file or its image shard (if any), or return None if it
+        could not be read."""
+        if self.shards is not None:
+            buf = self.shards.get_bytes(index)
+            return None if buf is None else buf.tobytes()
+        try:
+            with open(osp.join(self.root, self.store.image_path(index)), 'rb') as fp:
+                return fp.read()
+        except OSError:
+            return None
+
+    def image_nbytes(self, index):
+        """Get the size (in bytes) of the encoded index-th image (i.e., of its file or its image shard entry), without
+        reading it, or 0 if it does not exist."""
+        if self.shards is not None:
+            return int(self.shards.lengths[index])
+        try:
+            return os.stat(osp.join(self.root, self.store.image_path(index))).st_size
+        except OSError:
+            return 0
 
     def __repr__(self):
         fmt_str = 'Dataset ' + self.__class__.__name__ + '\n'
@@ -0,0 +1,68 @@
+import os
+import os.path as osp
+import json
+import numpy as np
+
+# Version of the bundle format
+BUNDLE_VERSION = 1
+
+
+def save_bundle(bundle_dir, arrays, **meta):
+    """Save a binary columnar annotation bundle, i.e., a directory with one .npy file per array, plus a `meta.json` file
+    listing the arrays (along with any other given metadata).
+
+    Args:
+        bundle_dir (str): bundle directory
+        arrays (dict): array name -> np.ndarray; arrays created by `create_bundle_array()` are already in place
+    """
+    if not osp.isdir(bundle_dir):
+        os.makedirs(bundle_dir)
+    for name, array in arrays.items():
+        filename = osp.join(bundle_dir, '{}.npy'.format(name))
+        if isinstance(array, np.memmap) and array.filename == osp.abspath(filename):
+            array.flush()
+            continue
+        np.save(filename, np.ascontiguousarray(array))
+    with open(osp.join(bundle_dir, 'meta.json'), 'w') as fp:
+        json.dump(dict(meta, version=BUNDLE_VERSION, arrays=list(arrays)), fp)
+
+
+def create_bundle_array(bundle_dir, name, shape, dtype):
+    """Create a (writable) memory-mapped array in a bundle directory, e.g., for arrays that do not fit in memory, which
+    are filled in place and then listed in the bundle by `save_bundle()`."""
+    if not osp.isdir(bundle_dir):
+        os.makedirs(bundle_dir)
+    return np.lib.format.open_memmap(osp.join(bundle_dir, '{}.npy'.format(name)), mode='w+', dtype=dtype, shape=shape)
+
+
+def load_bundle(bundle_dir, mmap_mode='r'):
+    """Load a binary columnar annotation bundle (e.g., the one written by `convert2coco.py --bundle`).
+
+    With memory mapping (default), loading takes (almost) no time regardless of the size of the bundle, and the pages of
+    the arrays are shared by all processes that load the same bundle (e.g., DataLoader workers).
+
+    Args:
+        bundle_dir (str): bundle directory
+        mmap_mode (str): memory mapping mode (see `np.load()`), or None for reading the arrays into memory
+
+    Returns:
+        arrays (dict): array name -> np.ndarray
+        meta (dict): bundle metadata
+    """
+    with open(osp.join(bundle_dir, 'meta.json'), 'r') as fp:
+        meta = json.load(fp)
+    if meta.get('version') != BUNDLE_VERSION:
+        raise RuntimeError("Unsupported annotation bundle version: {}".format(meta.get('version')))
+    arrays = {name: np.load(osp.join(bundle_dir, '{}.npy'.format(name)), mmap_mode=mmap_mode)
+              for name in meta['arrays']}
+    return arrays, meta
+
+
+def is_bundle(path):
+    return osp.isfile(osp.join(path, 'meta.json'))
+
+
+def get_bundle_path(arrays, index):
+    """Get the file path of the index-th image of a bundle."""
+    start, end = arrays['path_offsets'][index], arrays['path_offsets'][index + 1]
+    return arrays['paths'][start:end].tobytes().decode('utf-8')
@@ -0,0 +1,83 @@
+import threading
+from collections import OrderedDict
+
+
+class DecodedImageCache(object):
+    """LRU cache of decoded images (numpy arrays) with a byte budget.
+
+    The cache is private to the process that uses it; e.g., each DataLoader worker fills its own cache (up to
+    `max_bytes`) with the images it decodes, and keeps it across epochs as long as the workers are persistent (see
+    `persistent_workers`). Within a process, it may be used by several threads (e.g., see `AFLW.__getitems__()`).
+
+    Args:
+        max_bytes (int): maximum total size (in bytes) of the cached images; least recently used images are evicted
+                         once it is exceeded
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, load):
+        """Get the image with the given key (e.g., its path or index), calling `load()` to decode it on a cache miss.
+
+        The cached image is never handed out, i.e., a copy of it is returned (transforms may modify images in place).
+        """
+        with self._lock:
+            img = self._images.get(key)
+            if img is not None:
+                self.hits += 1
+                self._images.move_to_end(key)
+            else:
+                self.misses += 1
+        if img is not None:
+            return img.copy()
+        img = load()
+        if img is not None and img.nbytes <= self.max_bytes:
+            with self._lock:
+                if key not in self._images:
+                    self._images[key] = img.copy()
+                    self.num_bytes += img.nbytes
+                while self.num_bytes > self.max_bytes:
+                    _, evicted = self._images.popitem(last=False)
+                    self.num_bytes -= evicted.nbytes
+                    self.evictions += 1
+        return img
+
+    def __len__(self):
+        return len(self._images)
+
+    def __contains__(self, key):
+        return key in self._images
+
+    def clear(self):
+        with self._lock:
+            self._images.clear()
+            self.num_bytes = 0
+
+    def stats(self):
+        return {'images': len(self._images),
+                'bytes': self.num_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / (self.hits + self.misses) if self.hits + self.misses else 0.}
+
+    def __getstate__(self):
+        # Locks cannot be pickled; a copy of the cache gets its own lock
+        state = self.__dict__.copy()
+        state['_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '{}(max_bytes={}, images={}, bytes={}, hits={}, misses={})'.format(
+            self.__class__.__name__, self.max_bytes, len(self._images), self.num_bytes, self.hits, self.misses)
@@ -1,4 +1,6 @@
+import numpy as np
 import torch
+from torch.utils.data import get_worker_info
 
 
 def detection_collate(batch):
@@ -19,4 +21,97 @@ def detection_collate(batch):
         imgs.append(sample[0])
         targets.append(torch.FloatTensor(sample[1]))
 
+    # Images of batches fetched by `AFLW.__getitems__()` are already stacked
+    images = getattr(batch, 'images', None)
+    if images is not None:
+        return images, targets
     return torch.stack(imgs, 0), targets
+
+
+class DetectionCollator(object):
+    """Collate function that writes batches into preallocated (optionally pinned) tensors, and returns targets as a
+    single padded tensor, i.e., a fixed-shape alternative to `detection_collate`.
+
+    Images are copied once, straight into the batch tensor (images of batches fetched by `AFLW.__getitems__()`, which
+    are already stacked, are used as they are, unless they need to be pinned). Targets are returned as a
+    (B, max_faces, 5) tensor of [x1, y1, x2, y2, label] rows, padded with zeros, along with the (B,) number of faces of
+    each image.
+
+    Buffers are reused (in a ring of `num_buffers` batches) only when collating in the main process (i.e.,
+    `num_workers=0`), where the returned tensors of a batch are overwritten `num_buffers` batches later, so batches
+    (including any `non_blocking` copies of them) must not be used after that. In DataLoader worker processes, batches
+    are sent to the main process through shared memory, so new tensors are allocated for each batch, and are not pinned
+    (use `DataLoader(..., pin_memory=True)` instead).
+
+    Arguments:
+        max_faces (int, optional): number of target rows of each image (by default, the largest number of faces in the
+                                   batch)
+        pin_memory (bool): allocate buffers in pinned memory (if CUDA is available), for faster (and asynchronous)
+                           copies to the GPU
+        num_buffers (int): number of batches whose buffers are reused in turn (0 for no reuse)
+    """
+    def __init__(self, max_faces=None, pin_memory=False, num_buffers=2):
+        self.max_faces = max_faces
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.num_buffers = num_buffers
+        self._buffers = [dict() for _ in range(num_buffers)]
+        self._slot = 0
+
+    def __getstate__(self):
+        # Buffers are not sent to other processes (e.g., DataLoader workers)
+        state = self.__dict__.copy()
+        state['_buffers'] = [dict() for _ in range(self.num_buffers)]
+        return state
+
+    def _get_buffer(self, buffers, name, shape, dtype):
+        """Get a (shape) tensor, i.e., a view of the given buffer (reallocated if it is smaller), or a new tensor."""
+        if buffers is None:
+            return torch.empty(shape, dtype=dtype)
+        buf = buffers.get(name)
+        if buf is None or buf.dtype != dtype or buf.shape[1:] != shape[1:] or buf.shape[0] < shape[0]:
+            buf = torch.empty(shape, dtype=dtype, pin_memory=self.pin_memory)
+            buffers[name] = buf
+        return buf[:shape[0]]
+
+    def __call__(self, batch):
+        """
+        Arguments:
+            batch: (list) A list of (tensor image, array of annotations) samples
+
+        Return:
+            A tuple containing:
+                1) (tensor) batch of images, of shape (B, C, H, W)
+                2) (tensor) annotations of each image, of shape (B, max_faces, 5), padded with zeros
+                3) (tensor) number of annotations of each image, of shape (B,)
+        """
+        buffers = None
+        if self.num_buffers > 0 and get_worker_info() is None:
+            buffers = self._buffers[self._slot]
+            self._slot = (self._slot + 1) % self.num_buffers
+
+        # Images
+        images = getattr(batch, 'images', None)
+        if images is None or self.pin_memory and buffers is not None:
+            img = batch[0][0]
+            out = self._get_buffer(buffers, 'images', (len(batch),) + tuple(img.shape), img.dtype)
+            if images is not None:
+                out.copy_(images)
+            else:
+                for i, sample in enumerate(batch):
+                    out[i].copy_(sample[0])
+            images = out
+
+        # Targets, padded to a fixed number of rows
+        targets = [np.asarray(sample[1], dtype=np.float32).reshape(-1, 5) for sample in batch]
+        num_faces = [len(target) for target in targets]
+        max_faces = max(num_faces, default=0) if self.max_faces is None else self.max_faces
+        if max(num_faces, default=0) > max_faces:
+            raise ValueError("Number of faces of an image exceeds max_faces ({}): {}".format(max_faces, max(num_faces)))
+        counts = self._get_buffer(buffers, 'counts', (len(batch),), torch.int64)
+        counts.copy_(torch.as_tensor(num_faces, dtype=torch.int64))
+        out = self._get_buffer(buffers, 'targets', (len(batch), max_faces, 5), torch.float32)
+        out.zero_()
+        for i, target in enumerate(targets):
+            out[i, :len(target)] = torch.from_numpy(target)
+
+        return images, out, counts
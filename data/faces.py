@@ -0,0 +1,169 @@
+import os.path as osp
+import torch
+import torch.utils.data as data
+import cv2
+import numpy as np
+from .aflw import get_imread_flags
+from .bundle import load_bundle, get_bundle_path
+
+
+def get_crop_boxes(boxes, scale=1.5):
+    """Get the square crop box of each face, centered at the center of its bounding box, with a side of `scale` times
+    the longer side of the bounding box (i.e., `scale - 1` is the padding around the face).
+
+    Args:
+        boxes (np.ndarray): (N, 4) array of [x, y, width, height] face bounding boxes
+        scale (float): crop side over the longer side of the bounding box
+
+    Returns:
+        crop_boxes (np.ndarray): (N, 3) array of [x, y, side] crop boxes (top-left corner and side)
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    sides = np.maximum(boxes[:, 2], boxes[:, 3]) * scale
+    corners = boxes[:, :2] + (boxes[:, 2:] - sides[:, None]) / 2
+    return np.hstack((corners, sides[:, None]))
+
+
+def crop_keypoints(keypoints, crop_boxes):
+    """Map (N, K, 3) [x, y, visibility] keypoints (in image coordinates) onto the crops of the given (N, 3) crop boxes,
+    i.e., normalize them by the crop box; coordinates of keypoints that are not visible are set to zero."""
+    keypoints = np.array(keypoints, dtype=np.float32)
+    crop_boxes = np.asarray(crop_boxes, dtype=np.float64)
+    keypoints[:, :, :2] = (keypoints[:, :, :2] - crop_boxes[:, None, :2]) / crop_boxes[:, None, 2:]
+    keypoints[keypoints[:, :, 2] == 0, :2] = 0
+    return keypoints
+
+
+def extract_crops(img_file, crop_boxes, height, width, size, pad_value=0, out=None):
+    """Decode an image once and extract the crops of the given crop boxes, resized to `size` x `size` (parts of crops
+    that are outside the image are filled with `pad_value`).
+
+    The image is decoded at the lowest reduced resolution at which the smallest crop is still at least `size` x `size`
+    (see `get_imread_flags()`).
+
+    Args:
+        img_file (str): image file
+        crop_boxes (np.ndarray): (N, 3) array of [x, y, side] crop boxes, in the coordinates of the annotated image size
+        height (int): annotated image height
+        width (int): annotated image width
+        size (int): crop size
+        pad_value (int): value of padding outside the image
+        out (np.ndarray, optional): (N, size, size, 3) uint8 array to write the crops into
+
+    Returns:
+        crops (np.ndarray): (N, size, size, 3) uint8 array of crops (i.e., `out`, if given), or None if the image could
+                            not be read
+    """
+    crop_boxes = np.asarray(crop_boxes, dtype=np.float64).reshape(-1, 3)
+    min_side = int(crop_boxes[:, 2].min()) if len(crop_boxes) else 0
+    img = cv2.imread(img_file, get_imread_flags(min_side, min_side, size))
+    if img is None:
+        return None
+    if out is None:
+        out = np.empty((len(crop_boxes), size, size, 3), dtype=np.uint8)
+    # Scale of the decoded image with respect to the annotated one
+    scale_x, scale_y = img.shape[1] / width, img.shape[0] / height
+    for crop, (x, y, side) in zip(out, crop_boxes):
+        s = size / side
+        affine = np.array([[s / scale_x, 0, -x * s], [0, s / scale_y, -y * s]])
+        crop[...] = cv2.warpAffine(img, affine, (size, size), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT,
+                                   borderValue=(pad_value, pad_value, pad_value))
+    return out
+
+
+class AFLWFaces(data.Dataset):
+    """AFLW face dataset, i.e., one sample per face: a square crop around the face, its 21 keypoints (normalized by the
+    crop), and its head pose.
+
+    Faces are read from the binary annotation bundle written by `convert2coco.py --bundle`. Crops are either read from a
+    crop cache written by `pack_dataset.py crops` (i.e., extracted once, in parallel, and memory-mapped), or extracted
+    on the fly (i.e., the whole image of each face is decoded).
+
+    Arguments:
+        root (str): AFLW root directory
+        bundle (str): annotation bundle directory (see `convert2coco.py --bundle`)
+        crops (str, optional): crop cache directory (see `pack_dataset.py crops`); if given, `size`, `scale`, and
+                               `pad_value` are the ones the crops were extracted with
+        size (int): crop size (width and height)
+        scale (float): crop side over the longer side of the face bounding box (see `get_crop_boxes()`)
+        pad_value (int): value of padding outside the image
+        transform (callable, optional): transformation of a crop and its keypoints, called as
+                                        `transform(img, keypoints)` and returning the transformed `(img, keypoints)`
+    """
+    def __init__(self, root, bundle, crops=None, size=128, scale=1.5, pad_value=0, transform=None):
+        self.root = root
+        self.bundle, _ = load_bundle(bundle)
+        self.face_ids = self.bundle['face_ids']
+        self.transform = transform
+        # Image (index) of each face
+        self.image_index = np.repeat(np.arange(len(self.bundle['image_ids'])), np.diff(self.bundle['face_offsets']))
+        self.crops = None
+        if crops is not None:
+            self.crops, meta = load_bundle(crops)
+            if meta.get('kind') != 'crops' or not np.array_equal(self.crops['face_ids'], self.face_ids):
+                raise RuntimeError("Crops do not match annotation bundle {} (re-run pack_dataset.py): {}".format(
+                    bundle, crops))
+            size, scale, pad_value = meta['size'], meta['scale'], meta['pad_value']
+            self.crop_boxes = self.crops['crop_boxes']
+            self.keypoints = self.crops['keypoints']
+        else:
+            self.crop_boxes = get_crop_boxes(self.bundle['boxes'], scale)
+            self.keypoints = crop_keypoints(self.bundle['keypoints'], self.crop_boxes)
+        self.size = size
+        self.scale = scale
+        self.pad_value = pad_value
+
+    def __getitem__(self, index):
+        """
+        Args:
+            index (int): Index
+        Returns:
+            tuple: Tuple (image, keypoints, pose).
+        """
+        im, keypoints, pose, face_id, img_path = self.pull_item(index)
+        return im, keypoints, pose
+
+    def __len__(self):
+        return len(self.face_ids)
+
+    def pull_item(self, index):
+        """
+        Args:
+            index (int): Index
+        Returns:
+            tuple: Tuple (image, keypoints, pose, face id, image path), where keypoints is a (21, 3) array of
+                   [x, y, visibility] keypoints, normalized by the crop, and pose is the (roll, pitch, yaw) head pose,
+                   in radians.
+        """
+        img_path = osp.join(self.root, get_bundle_path(self.bundle, self.image_index[index]))
+        img = self.pull_crop(index)
+        keypoints = np.array(self.keypoints[index])
+        if self.transform is not None:
+            img, keypoints = self.transform(img, keypoints)
+        pose = np.array(self.bundle['pose'][index])
+        return torch.from_numpy(img).permute(2, 0, 1), keypoints, pose, int(self.face_ids[index]), img_path
+
+    def pull_crop(self, index):
+        """Get the crop (BGR) of the index-th face, from the crop cache (if any), or by extracting it from its image."""
+        if self.crops is not None:
+            if not self.crops['valid'][index]:
+                raise RuntimeError("Image of face {} could not be read when packing crops".format(self.face_ids[index]))
+            return np.array(self.crops['crops'][index])
+        image_index = self.image_index[index]
+        img_path = osp.join(self.root, get_bundle_path(self.bundle, image_index))
+        assert osp.exists(img_path), 'Image path does not exist: {}'.format(img_path)
+        crops = extract_crops(img_path, self.crop_boxes[index:index + 1], self.bundle['heights'][image_index],
+                              self.bundle['widths'][image_index], self.size, self.pad_value)
+        if crops is None:
+            raise RuntimeError("Image of face {} could not be read: {}".format(self.face_ids[index], img_path))
+        return crops[0]
+
+    def __repr__(self):
+        fmt_str = 'Dataset ' + self.__class__.__name__ + '\n'
+        fmt_str += '    Number of data points: {}\n'.format(self.__len__())
+        fmt_str += '    Root Location: {}\n'.format(self.root)
+        fmt_str += '    Crops: {0}x{0}, scale {1}{2}\n'.format(self.size, self.scale,
+                                                               ' (cached)' if self.crops is not None else '')
+        tmp = '    Transforms (if any): '
+        fmt_str += '{0}{1}'.format(tmp, self.transform.__repr__().replace('\n', '\n' + ' ' * len(tmp)))
+        return fmt_str
@@ -0,0 +1,127 @@
+import hashlib
+import os
+import os.path as osp
+import re
+import shutil
+import tempfile
+import numpy as np
+from .json_io import load_json
+from .bundle import save_bundle, load_bundle, is_bundle
+
+# Version of the annotation index; cached indexes of another version are rebuilt
+INDEX_VERSION = 2
+
+
+def sha256sum(filename, chunk_size=1 << 20):
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def build_index(dataset_dict):
+    """Build a compact annotation index of a COCO-style dataset, i.e., flat arrays of the image ids, sizes, and paths,
+    and of the bounding boxes and labels of each image (in CSR layout, i.e., the boxes of the i-th image are
+    `boxes[box_offsets[i]:box_offsets[i + 1]]`), along with the detection targets (and keypoints, if all annotations
+    have the same number of them) of each box, normalized by the image size (see `build_targets()`).
+
+    Images are indexed in the same order as `COCO.imgToAnns` (i.e., in order of their first annotation), and images
+    without annotations are left out.
+
+    Args:
+        dataset_dict (dict): COCO-style dataset dictionary
+
+    Returns:
+        arrays (dict): array name -> np.ndarray
+    """
+    images = {image['id']: image for image in dataset_dict['images']}
+    image_anns = dict()
+    for ann in dataset_dict['annotations']:
+        image_anns.setdefault(ann['image_id'], []).append(ann)
+    image_ids = list(image_anns)
+    paths = [images[image_id]['file_name'].encode('utf-8') for image_id in image_ids]
+    anns = [ann for image_id in image_ids for ann in image_anns[image_id]]
+    arrays = {'image_ids': np.array(image_ids, dtype=np.int64),
+              'widths': np.array([images[image_id]['width'] for image_id in image_ids], dtype=np.int32),
+              'heights': np.array([images[image_id]['height'] for image_id in image_ids], dtype=np.int32),
+              'path_offsets': np.cumsum([0] + [len(path) for path in paths], dtype=np.int64),
+              'paths': np.frombuffer(b''.join(paths), dtype=np.uint8),
+              'box_offsets': np.cumsum([0] + [len(image_anns[image_id]) for image_id in image_ids], dtype=np.int64),
+              'boxes': np.array([ann['bbox'] for ann in anns], dtype=np.float64).reshape(-1, 4),
+              'labels': np.array([ann['category_id'] for ann in anns], dtype=np.int64),
+              'ann_ids': np.array([ann['id'] for ann in anns], dtype=np.int64)}
+    keypoints = None
+    if anns and len(set(len(ann.get('keypoints', [])) for ann in anns)) == 1 and anns[0].get('keypoints'):
+        keypoints = np.array([ann['keypoints'] for ann in anns], dtype=np.float64).reshape(len(anns), -1, 3)
+    arrays.update(build_targets(arrays, keypoints))
+    return arrays
+
+
+def build_targets(arrays, keypoints=None):
+    """Build the detection targets of all boxes of an index at once, i.e., an (N, 5) float32 array of normalized
+    [x1, y1, x2, y2, label] rows, and, if the (N, K, 3) keypoints of the boxes are given, an (N, K, 3) float32 array of
+    normalized [x, y, visibility] keypoints."""
+    sizes = np.repeat(np.stack((arrays['widths'], arrays['heights']), axis=1), np.diff(arrays['box_offsets']), axis=0)
+    boxes = arrays['boxes']
+    targets = np.empty((len(boxes), 5), dtype=np.float32)
+    targets[:, :2] = boxes[:, :2] / sizes
+    targets[:, 2:4] = (boxes[:, :2] + boxes[:, 2:4]) / sizes
+    targets[:, 4] = arrays['labels']
+    res = {'targets': targets}
+    if keypoints is not None:
+        keypoints = keypoints.copy()
+        keypoints[:, :, :2] /= sizes[:, None, :]
+        res['keypoints'] = keypoints.astype(np.float32)
+    return res
+
+
+def load_index(json_file, cache_dir=None):
+    """Load the annotation index (see `build_index()`) of a (possibly compressed) COCO json annotation file.
+
+    The index is built on first use and cached as an annotation bundle (see `data.bundle`) keyed by the path and the
+    SHA-256 hash of the json file, so that subsequent loads (e.g., by each DataLoader worker or each evaluation job)
+    only hash the file and memory-map the cached arrays, instead of parsing and indexing the json file. If the cache
+    directory is not writable, the index is built in memory (i.e., the returned arrays are not memory-mapped).
+
+    Args:
+        json_file (str): COCO json annotation file
+        cache_dir (str, optional): cache directory (by default `.aflw_index`, next to the json file)
+
+    Returns:
+        arrays (dict): array name -> np.ndarray
+    """
+    cache_dir = cache_dir or osp.join(osp.dirname(osp.abspath(json_file)), '.aflw_index')
+    # Indexes of json files with the same name (e.g., in different directories) sharing a cache directory are told
+    # apart by a hash of the path of the json file
+    json_path = osp.abspath(json_file)
+    cache_name = '{}.{}'.format(osp.basename(json_file), hashlib.sha256(json_path.encode('utf-8')).hexdigest()[:8])
+    index_dir = osp.join(cache_dir, '{}.{}'.format(cache_name, sha256sum(json_file)[:16]))
+    if is_bundle(index_dir):
+        arrays, meta = load_bundle(index_dir)
+        if meta.get('index_version') == INDEX_VERSION:
+            return arrays
+        shutil.rmtree(index_dir, ignore_errors=True)
+
+    arrays = build_index(load_json(json_file))
+    try:
+        if not osp.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # Write the index to a temporary directory, which is then renamed, so that concurrent loads never see a
+        # partially written index; indexes of previous versions of the json file are removed.
+        tmp_dir = tempfile.mkdtemp(dir=cache_dir)
+        save_bundle(tmp_dir, arrays, index_version=INDEX_VERSION, json=json_path)
+        for name in os.listdir(cache_dir):
+            if re.fullmatch(r'{}\.[0-9a-f]{{16}}'.format(re.escape(cache_name)), name) and \
+                    name != osp.basename(index_dir):
+                shutil.rmtree(osp.join(cache_dir, name), ignore_errors=True)
+        try:
+            os.rename(tmp_dir, index_dir)
+        except OSError:
+            # The index has been written meanwhile (e.g., by another process)
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        # Use the memory-mapped arrays of the cached index, instead of the ones built in memory
+        arrays, _ = load_bundle(index_dir)
+    except OSError:
+        pass
+    return arrays
@@ -0,0 +1,56 @@
+import gzip
+import io
+import json
+import lzma
+
+# Supported compression formats of json annotation files: name -> (file extension, magic bytes)
+COMPRESSIONS = {'gzip': ('.gz', b'\x1f\x8b'), 'xz': ('.xz', b'\xfd7zXZ\x00')}
+
+
+def get_compression(filename):
+    """Get the compression format of a json annotation file from its extension (e.g., 'aflw.json.gz' -> 'gzip'), or
+    None if it is not compressed."""
+    for compression, (ext, _) in COMPRESSIONS.items():
+        if filename.endswith(ext):
+            return compression
+    return None
+
+
+def open_json(filename, mode='r', compression='auto'):
+    """Open a (possibly compressed) json annotation file in text mode.
+
+    Args:
+        filename (str): json file
+        mode (str): 'r' or 'w'
+        compression (str): 'gzip', 'xz', 'none', or 'auto', i.e., when reading, detect the compression format from the
+                           file's magic bytes, and, when writing, get it from the file's extension
+
+    Returns:
+        fp (file): text file object
+    """
+    if compression == 'auto':
+        if mode == 'r':
+            with open(filename, 'rb') as fp:
+                magic = fp.read(6)
+            compression = None
+            for name, (_, magic_bytes) in COMPRESSIONS.items():
+                if magic.startswith(magic_bytes):
+                    compression = name
+        else:
+            compression = get_compression(filename)
+    if compression == 'gzip':
+        # A fixed modification time in the gzip header keeps compressed outputs reproducible
+        fp = gzip.GzipFile(filename, mode='{}b'.format(mode), mtime=0)
+    elif compression == 'xz':
+        fp = lzma.LZMAFile(filename, mode='{}b'.format(mode))
+    elif compression in (None, 'none'):
+        return open(filename, mode, encoding='utf-8')
+    else:
+        raise ValueError("Unsupported compression format: {}".format(compression))
+    return io.TextIOWrapper(fp, encoding='utf-8')
+
+
+def load_json(filename):
+    """Load a (possibly compressed) json annotation file."""
+    with open_json(filename, 'r') as fp:
+        return json.load(fp)
@@ -0,0 +1,201 @@
+import os
+import threading
+import warnings
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import torch.utils.data as data
+
+
+class ReadAheadPrefetcher(object):
+    """Read-ahead of encoded image bytes by a background thread pool, so that reading an image (e.g., its file open and
+    read latency on network storage) is overlapped with decoding the previous ones.
+
+    Given the order in which images are going to be read (see `set_order()`, or `ReadAheadSampler`), the bytes of the
+    next `read_ahead` images after the last one read are read in the background, as long as the bytes of the images
+    that are being read or have been read ahead (and not consumed yet) are within `max_bytes`; the size of each image
+    is reserved when its read is submitted (see `size`), so that reads in flight are accounted for. Reading an image
+    (see `get()`) then takes its bytes from memory (a hit), waits for them if they are still being read, or reads them
+    right away if they were not read ahead (a miss, e.g., if no order was given).
+
+    The order is only known to the process that iterates the sampler, so read-ahead takes place when the dataset is
+    read in the same process (e.g., `num_workers=0`, where the thread pool takes the place of DataLoader workers). The
+    thread pool, order, and pending reads are not inherited by other processes: in DataLoader workers (whether forked or
+    spawned), or when pickled, the prefetcher has no order and every read is a miss (a warning is issued on the first
+    read in each DataLoader worker). Images may be read by several threads (e.g., see `AFLW.__getitems__()`).
+
+    Args:
+        read (callable): reads the bytes of the index-th image, i.e., `read(index)`
+        read_ahead (int): maximum number of images read ahead
+        max_bytes (int): maximum total size (in bytes) of images read ahead and not consumed yet
+        num_threads (int): number of reader threads
+        size (callable, optional): gets the size (in bytes) of the index-th image before reading it, i.e.,
+                                   `size(index)`; if not given, images only count towards `max_bytes` once read
+    """
+    def __init__(self, read, read_ahead=32, max_bytes=256 * 2 ** 20, num_threads=8, size=None):
+        self.read = read
+        self.size = size
+        self.read_ahead = read_ahead
+        self.max_bytes = max_bytes
+        self.num_threads = num_threads
+        self.hits = 0
+        self.waits = 0
+        self.misses = 0
+        self.bytes_read_ahead = 0
+        self._executor = None
+        self._order = []
+        self._positions = dict()
+        self._next = 0
+        self._futures = OrderedDict()
+        self._sizes = dict()
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._warned = False
+
+    def __getstate__(self):
+        # The thread pool and pending reads are not inherited by other processes, nor is the order
+        state = self.__dict__.copy()
+        state.update(_executor=None, _order=[], _positions=dict(), _next=0, _futures=OrderedDict(), _sizes=dict(),
+                     _lock=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _check_process(self):
+        # A forked process (e.g., a DataLoader worker) inherits the state of the prefetcher, but not its reader threads:
+        # the pending reads would never complete (and the lock may have been held by one of them), so it is reset
+        if self._pid != os.getpid():
+            self.__setstate__(self.__getstate__())
+
+    def set_order(self, order):
+        """Set the order in which images are going to be read (e.g., the indices of an epoch, as sampled), dropping any
+        images read ahead in the previous order, and start reading ahead its first images."""
+        self._check_process()
+        with self._lock:
+            self._cancel()
+            self._order = [int(index) for index in order]
+            self._positions = {index: position for position, index in enumerate(self._order)}
+            self._next = 0
+            self._schedule()
+
+    def get(self, index):
+        """Get the bytes of the index-th image."""
+        self._check_process()
+        if not self._warned and data.get_worker_info() is not None:
+            self._warned = True
+            warnings.warn("Images are not read ahead in DataLoader worker processes (the read-ahead order is only "
+                          "known to the process that iterates the sampler): use num_workers=0, or read_ahead=0")
+        with self._lock:
+            future = self._futures.pop(index, None)
+            self._sizes.pop(index, None)
+            if future is None:
+                self.misses += 1
+            elif future.done():
+                self.hits += 1
+            else:
+                self.waits += 1
+            # Read ahead from the position of this image in the order; images read ahead for positions more than
+            # `read_ahead` before it (i.e., that have been skipped, e.g., as they were in the decoded image cache) are
+            # dropped, while images of nearby positions may still be read (e.g., by other threads of a batch)
+            position = self._positions.get(index)
+            if position is not None:
+                while self._futures and self._positions[next(iter(self._futures))] < position - self.read_ahead:
+                    skipped, skipped_future = self._futures.popitem(last=False)
+                    skipped_future.cancel()
+                    self._sizes.pop(skipped, None)
+                self._next = max(self._next, position + 1)
+                self._schedule()
+        if future is None:
+            return self.read(index)
+        buf = future.result()
+        with self._lock:
+            self.bytes_read_ahead += len(buf or b'')
+        return buf
+
+    def _pending_bytes(self):
+        # Bytes reserved by the reads that are in flight or not consumed yet (i.e., the size of each image, if known
+        # beforehand, or else its bytes, once read)
+        pending = 0
+        for index, future in self._futures.items():
+            size = self._sizes.get(index)
+            if size is None and future.done() and not future.cancelled() and future.exception() is None:
+                size = len(future.result() or b'')
+            pending += size or 0
+        return pending
+
+    def _schedule(self):
+        if self._next >= len(self._order) or len(self._futures) >= self.read_ahead:
+            return
+        pending = self._pending_bytes()
+        if pending >= self.max_bytes:
+            return
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.num_threads)
+        # Reads are submitted as long as their images fit in the budget (or nothing else is pending, however large the
+        # image is)
+        while self._next < len(self._order) and len(self._futures) < self.read_ahead:
+            index = self._order[self._next]
+            if index not in self._futures:
+                size = self.size(index) if self.size is not None else None
+                if self._futures and pending + (size or 0) > self.max_bytes:
+                    break
+                self._sizes[index] = size
+                self._futures[index] = self._executor.submit(self.read, index)
+                pending += size or 0
+            self._next += 1
+
+    def _cancel(self):
+        for future in self._futures.values():
+            future.cancel()
+        self._futures.clear()
+        self._sizes.clear()
+
+    def close(self):
+        self._check_process()
+        with self._lock:
+            self._cancel()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def stats(self):
+        self._check_process()
+        with self._lock:
+            reads = self.hits + self.waits + self.misses
+            return {'hits': self.hits,
+                    'waits': self.waits,
+                    'misses': self.misses,
+                    'in_flight': len(self._futures),
+                    'pending_bytes': self._pending_bytes(),
+                    'bytes_read_ahead': self.bytes_read_ahead,
+                    'hit_rate': self.hits / reads if reads else 0.}
+
+    def __repr__(self):
+        return '{}(read_ahead={}, max_bytes={}, hits={}, waits={}, misses={})'.format(
+            self.__class__.__name__, self.read_ahead, self.max_bytes, self.hits, self.waits, self.misses)
+
+
+class ReadAheadSampler(data.Sampler):
+    """Sampler wrapper that hands the order of each epoch (i.e., the indices sampled by `sampler`) to a read-ahead
+    prefetcher (e.g., `AFLW(..., read_ahead=32).prefetcher`) before yielding it.
+
+    The dataset has to be read in the process that iterates the sampler (i.e., by a DataLoader with `num_workers=0`);
+    with DataLoader workers, the images read ahead at the start of each epoch are never used.
+
+    Args:
+        sampler (iterable): sampler of dataset indices (e.g., `RandomSampler(dataset)`)
+        prefetcher (ReadAheadPrefetcher): prefetcher of the dataset
+    """
+    def __init__(self, sampler, prefetcher):
+        self.sampler = sampler
+        self.prefetcher = prefetcher
+
+    def __iter__(self):
+        order = list(self.sampler)
+        self.prefetcher.set_order(order)
+        return iter(order)
+
+    def __len__(self):
+        return len(self.sampler)
@@ -0,0 +1,59 @@
+import mmap
+import os.path as osp
+import numpy as np
+import cv2
+from .bundle import load_bundle
+
+
+class ImageShards(object):
+    """Reader of encoded images packed into a few large shard files (see `pack_dataset.py shards`).
+
+    The shard files are memory-mapped on first access (in each process), and each image is decoded straight from its
+    bytes in the mapping with `cv2.imdecode()`, i.e., reading an image makes no system calls (no stat, open, or read of
+    a small file), and the OS reads the shards in large sequential chunks.
+
+    Args:
+        pack_dir (str): directory of the shard files and their offset index
+    """
+    def __init__(self, pack_dir):
+        self.pack_dir = pack_dir
+        self.index, self.meta = load_bundle(pack_dir)
+        if self.meta.get('kind') != 'shards':
+            raise RuntimeError("Not an image shards directory: {}".format(pack_dir))
+        self.image_ids = self.index['image_ids']
+        self.shard_ids = self.index['shard_ids']
+        self.offsets = self.index['offsets']
+        self.lengths = self.index['lengths']
+        self._maps = None
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def __getstate__(self):
+        # Memory mappings are not inherited by spawned processes; they are opened again on first access
+        state = self.__dict__.copy()
+        state['_maps'] = None
+        return state
+
+    def _open(self):
+        # Shards are mapped before being published, as images may be read by several threads
+        maps = []
+        for shard_file in self.meta['shards']:
+            with open(osp.join(self.pack_dir, shard_file), 'rb') as fp:
+                maps.append(mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ))
+        self._maps = maps
+
+    def get_bytes(self, index):
+        """Get the encoded bytes of the index-th image as a (zero-copy) uint8 array, or None if it was not packed."""
+        length = int(self.lengths[index])
+        if length == 0:
+            return None
+        if self._maps is None:
+            self._open()
+        return np.frombuffer(self._maps[self.shard_ids[index]], dtype=np.uint8, count=length,
+                             offset=int(self.offsets[index]))
+
+    def decode(self, index, flags=cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION):
+        """Decode the index-th image (BGR), or return None if it was not packed."""
+        buf = self.get_bytes(index)
+        return None if buf is None else cv2.imdecode(buf, flags)
@@ -0,0 +1,77 @@
+import os.path as osp
+import shutil
+import tempfile
+import numpy as np
+from .bundle import save_bundle, load_bundle, get_bundle_path
+from .index import load_index
+
+
+def share_arrays(arrays):
+    """Move arrays to memory-mapped files (in shared memory, i.e., `/dev/shm`, if available), so that their pages are
+    shared by all (forked) processes, instead of being copied into the private memory of each of them. The files are
+    unlinked right away; their pages stay mapped until the arrays are garbage collected."""
+    tmp_dir = tempfile.mkdtemp(dir='/dev/shm' if osp.isdir('/dev/shm') else None)
+    try:
+        save_bundle(tmp_dir, arrays)
+        arrays, _ = load_bundle(tmp_dir, mmap_mode='r')
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return arrays
+
+
+class AnnotationStore(object):
+    """Array-backed store of the annotations of a COCO-style dataset (see `data.index.build_index()`).
+
+    All annotations are kept in a few flat, read-only, memory-mapped numpy arrays, instead of nested Python dicts and
+    lists. Reading them (e.g., by `AFLW.pull_item()`) does not touch the reference counts of any long-lived Python
+    objects, so the pages of the store are never copied by forked DataLoader workers (copy-on-write), and are shared by
+    all processes that load the same cached index.
+
+    Args:
+        arrays (dict): array name -> np.ndarray (arrays that are not memory-mapped are moved to shared memory)
+    """
+    def __init__(self, arrays):
+        if not all(isinstance(array, np.memmap) for array in arrays.values()):
+            arrays = share_arrays(arrays)
+        self.arrays = arrays
+        self.image_ids = arrays['image_ids']
+        self.widths = arrays['widths']
+        self.heights = arrays['heights']
+        self.box_offsets = arrays['box_offsets']
+        self.boxes = arrays['boxes']
+        self.labels = arrays['labels']
+        self.ann_ids = arrays['ann_ids']
+        self.targets = arrays['targets']
+        self.keypoints = arrays.get('keypoints')
+
+    @classmethod
+    def from_json(cls, json_file, cache_dir=None):
+        """Create the store of a COCO json annotation file from its (cached) index (see `data.index.load_index()`)."""
+        return cls(load_index(json_file, cache_dir=cache_dir))
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def image_id(self, index):
+        return int(self.image_ids[index])
+
+    def image_size(self, index):
+        """Get the (height, width) of the index-th image, as annotated."""
+        return int(self.heights[index]), int(self.widths[index])
+
+    def image_path(self, index):
+        """Get the file path (relative to the dataset root) of the index-th image."""
+        return get_bundle_path(self.arrays, index)
+
+    def annotation_slice(self, index):
+        return slice(int(self.box_offsets[index]), int(self.box_offsets[index + 1]))
+
+    def annotations(self, index):
+        """Get the annotations of the index-th image as an (N, 5) array of [x, y, width, height, category id] rows."""
+        ann_slice = self.annotation_slice(index)
+        return np.hstack((self.boxes[ann_slice], self.labels[ann_slice, None]))
+
+    def get_keypoints(self, index):
+        """Get the precomputed keypoints of the index-th image, i.e., a (read-only) view of its (N, K, 3) float32 array
+        of [x, y, visibility] keypoints, normalized by the annotated image size, or None if the dataset has none."""
+        return None if self.keypoints is None else self.keypoints[self.annotation_slice(index)]
@@ -0,0 +1,90 @@
+import struct
+
+# JPEG start-of-frame markers (i.e., all SOFn markers, except DHT (0xC4), JPG (0xC8), and DAC (0xCC))
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+# JPEG markers that do not carry a length field (TEM, RST0-RST7, SOI)
+JPEG_STANDALONE_MARKERS = {0x01, 0xD0, 0xD1, 0xD2, 0xD3, 0xD4, 0xD5, 0xD6, 0xD7, 0xD8}
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def _read_jpeg_size(fp):
+    """Walk the JPEG marker segments up to the first start-of-frame segment and read the image size from it. Only the
+    segment headers are read; the payload of each preceding segment (e.g., EXIF, ICC profiles) is skipped by seeking.
+    """
+    while True:
+        # Find next marker (markers may be preceded by any number of 0xFF fill bytes)
+        byte = fp.read(1)
+        while byte and byte != b'\xff':
+            byte = fp.read(1)
+        while byte == b'\xff':
+            byte = fp.read(1)
+        if not byte:
+            return None
+        marker = byte[0]
+        if marker in JPEG_STANDALONE_MARKERS:
+            continue
+        if marker == 0xD9:
+            return None
+        segment = fp.read(2)
+        if len(segment) < 2:
+            return None
+        length = struct.unpack('>H', segment)[0]
+        if marker in JPEG_SOF_MARKERS:
+            sof = fp.read(5)
+            if len(sof) < 5:
+                return None
+            height, width = struct.unpack('>xHH', sof)
+            return width, height
+        fp.seek(length - 2, 1)
+
+
+def _read_png_size(fp):
+    """Read the image size from the IHDR chunk, which is required to be the first chunk of a PNG file."""
+    ihdr = fp.read(16)
+    if len(ihdr) < 16 or ihdr[4:8] != b'IHDR':
+        return None
+    return struct.unpack('>II', ihdr[8:16])
+
+
+def get_img_size_header(image_filename):
+    """Get the size (width, height) of a JPEG or PNG image by parsing its header only (i.e., without decoding the image
+    or importing an image library).
+
+    Returns:
+        (width, height), or None if the file is not a JPEG/PNG image or its header could not be parsed
+    """
+    with open(image_filename, 'rb') as fp:
+        signature = fp.read(8)
+        if signature[:2] == b'\xff\xd8':
+            fp.seek(2)
+            return _read_jpeg_size(fp)
+        elif signature == PNG_SIGNATURE:
+            return _read_png_size(fp)
+    return None
+
+
+def get_img_size_pil(image_filename):
+    """Get the size (width, height) of an image using PIL (which only reads the image header, but it is slower to
+    import and to set up per file)."""
+    from PIL import Image
+    with Image.open(image_filename) as im:
+        return im.size[0], im.size[1]
+
+
+def get_img_size(image_filename, backend='header'):
+    """Get the size (width, height) of an image.
+
+    Args:
+        image_filename (str): image file
+        backend (str): 'header' for parsing JPEG/PNG headers directly, falling back to PIL for any other format, or
+                       'pil' for always using PIL
+    """
+    if backend == 'header':
+        img_size = get_img_size_header(image_filename)
+        if img_size is not None:
+            return img_size
+    elif backend != 'pil':
+        raise ValueError("Unknown image size backend: {}".format(backend))
+    return get_img_size_pil(image_filename)
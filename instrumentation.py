@@ -0,0 +1,242 @@
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # e.g., on Windows
+    resource = None
+
+
+def cpu_time():
+    """Return the CPU time (user + system) consumed by the current process and its terminated child processes (e.g., the
+    workers of a process pool that has been shut down)."""
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+def peak_rss(who=None):
+    """Return the peak resident set size (in MB) of the current process and of its largest terminated child process (or
+    only of the one given by `who`, e.g., `resource.RUSAGE_CHILDREN`), or None if it is not available on this
+    platform."""
+    if resource is None:
+        return None
+    # ru_maxrss is given in bytes on macOS and in kilobytes elsewhere
+    scale = 1. / 2 ** 20 if sys.platform == 'darwin' else 1. / 2 ** 10
+    if who is not None:
+        return scale * resource.getrusage(who).ru_maxrss
+    return scale * max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                       resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def reset_peak_rss():
+    """Reset the peak resident set size of the current process (i.e., its `VmHWM`, on Linux) to its current resident set
+    size, and return True, or return False if it cannot be reset on this platform."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as fp:
+            fp.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def get_hwm_rss():
+    """Return the peak resident set size (in MB) of the current process since it was last reset (see
+    `reset_peak_rss()`), i.e., its `VmHWM` (on Linux), or None if it is not available."""
+    try:
+        with open('/proc/self/status') as fp:
+            for line in fp:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2 ** 10
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{:d}:{:02d}:{:02d}'.format(hours, minutes, seconds)
+
+
+class ProgressReporter(object):
+    """Report the progress, throughput (items/s), and ETA of a loop.
+
+    On a terminal, a progress bar is re-drawn in place at most once every `interval` seconds (instead of once per item),
+    and always when the loop completes. Otherwise (e.g., in batch jobs whose output is redirected to a log file), a
+    structured (json) log line is emitted at most once every `interval` seconds and when the loop completes, e.g.:
+
+        {"event": "progress", "name": "image_probing", "done": 1200, "total": 21123, "percent": 5.7,
+         "rate": 412.5, "elapsed": 2.91, "eta": 48.3}
+
+    Args:
+        msg (str): message shown before the progress bar
+        total (int): total number of items
+        name (str, optional): name of the loop in structured log lines (by default the stripped message)
+        unit (str): unit of items
+        interval (float, optional): minimum time (in seconds) between reports (by default 0.1 on a terminal, 10 else)
+        structured (bool, optional): emit structured log lines (by default when the stream is not a terminal)
+        stream (file, optional): output stream (by default sys.stdout)
+    """
+    def __init__(self, msg, total, name=None, unit='it', interval=None, structured=None, stream=None):
+        self.msg = msg
+        self.total = total
+        self.name = name or msg.strip(' .\\_')
+        self.unit = unit
+        self.stream = stream or sys.stdout
+        self.structured = structured if structured is not None else not self.stream.isatty()
+        self.interval = interval if interval is not None else (10. if self.structured else 0.1)
+        self.done = 0
+        self.start_time = time.perf_counter()
+        self.last_report_time = None
+        self.closed = False
+
+    def update(self, done=None, n=1):
+        """Set the number of completed items (if `done` is given), or increase it by `n`."""
+        self.done = self.done + n if done is None else done
+        now = time.perf_counter()
+        if self.done >= self.total:
+            self.close()
+        elif self.last_report_time is None or now - self.last_report_time >= self.interval:
+            self._report(now)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._report(time.perf_counter())
+
+    def _report(self, now):
+        self.last_report_time = now
+        elapsed = now - self.start_time
+        rate = self.done / elapsed if elapsed > 0 else 0.
+        eta = (self.total - self.done) / rate if rate > 0 else None
+        progress = min(1., float(self.done) / float(self.total)) if self.total else 1.
+        if self.structured:
+            self.stream.write('{}\n'.format(json.dumps({'event': 'progress',
+                                                        'name': self.name,
+                                                        'done': self.done,
+                                                        'total': self.total,
+                                                        'percent': round(100 * progress, 1),
+                                                        'rate': round(rate, 1),
+                                                        'elapsed': round(elapsed, 2),
+                                                        'eta': None if eta is None else round(eta, 1)})))
+        else:
+            bar_length = 20
+            block = int(round(bar_length * progress))
+            self.stream.write("\r{}[{}] {:.0f}% {:.1f} {}/s ETA {}{}".format(
+                self.msg, "#" * block + "-" * (bar_length - block), round(progress * 100, 0), rate, self.unit,
+                '-:--:--' if eta is None else format_duration(eta), "\r\n" if self.closed else " "))
+        self.stream.flush()
+
+
+class StageProfiler(object):
+    """Record wall time, CPU time, throughput, and peak RSS of the stages of a script, as well as named counters.
+
+    The peak RSS of a stage is the one reached during the stage, by the process itself (its peak RSS is reset at the
+    start of each stage, see `reset_peak_rss()`) or by any child process that terminated during the stage (e.g., the
+    workers of a process pool), so that stages that use less memory than a previous one are still told apart. Where the
+    peak RSS cannot be reset (i.e., not on Linux), the peak RSS of stages is not recorded (only the one of the whole
+    script).
+
+    Example:
+        profiler = StageProfiler()
+        profiler.start('sql_count')
+        ...
+        profiler.stop(items=num_rows, unit='rows')
+        with profiler.stage('json_write', unit='files') as stage:
+            ...
+            stage['items'] = num_files
+        profiler.count('missing_images', num_missing)
+        profiler.print_summary()
+    """
+    def __init__(self):
+        self.stages = []
+        self.counters = dict()
+        self._current = None
+        self._start = None
+        # Peak RSS of terminated child processes at the start of the current stage (None if the peak RSS of stages is
+        # not recorded), and of the whole script so far (which resetting the peak RSS of the process would lose)
+        self._children_rss = None
+        self._max_rss = None
+
+    def start(self, name):
+        if self._current is not None:
+            self.stop()
+        self._current = name
+        self._start = (time.perf_counter(), cpu_time())
+        self._max_rss = self._get_max_rss()
+        self._children_rss = None
+        if resource is not None and reset_peak_rss():
+            self._children_rss = peak_rss(resource.RUSAGE_CHILDREN)
+
+    def stop(self, items=None, unit='items'):
+        wall, cpu = time.perf_counter() - self._start[0], cpu_time() - self._start[1]
+        stage_peak_rss = None
+        if self._children_rss is not None:
+            stage_peak_rss = get_hwm_rss()
+            children_rss = peak_rss(resource.RUSAGE_CHILDREN)
+            if children_rss > self._children_rss:
+                stage_peak_rss = max(stage_peak_rss or 0., children_rss)
+        self.stages.append({'stage': self._current,
+                            'wall_time': wall,
+                            'cpu_time': cpu,
+                            'items': items,
+                            'unit': unit,
+                            'rate': items / wall if items is not None and wall > 0 else None,
+                            'peak_rss_mb': stage_peak_rss})
+        self._current, self._start, self._children_rss = None, None, None
+        self._max_rss = self._get_max_rss()
+        return self.stages[-1]
+
+    def _get_max_rss(self):
+        rss = [value for value in (self._max_rss, peak_rss()) if value is not None]
+        return max(rss) if rss else None
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    @contextmanager
+    def stage(self, name, unit='items'):
+        self.start(name)
+        counters = {'items': None}
+        try:
+            yield counters
+        finally:
+            self.stop(items=counters['items'], unit=unit)
+
+    def summary(self):
+        return {'stages': self.stages,
+                'total_wall_time': sum(stage['wall_time'] for stage in self.stages),
+                'total_cpu_time': sum(stage['cpu_time'] for stage in self.stages),
+                'counters': self.counters,
+                'peak_rss_mb': self._get_max_rss()}
+
+    def print_summary(self, file=None):
+        file = file or sys.stdout
+        summary = self.summary()
+        row_fmt = "  {:<16} {:>10} {:>10} {:>12} {:>18} {:>14}"
+        print(row_fmt.format('stage', 'wall (s)', 'cpu (s)', 'items', 'rate', 'peak rss (MB)'), file=file)
+        for stage in self.stages:
+            print(row_fmt.format(stage['stage'],
+                                 '{:.3f}'.format(stage['wall_time']),
+                                 '{:.3f}'.format(stage['cpu_time']),
+                                 '-' if stage['items'] is None else stage['items'],
+                                 '-' if stage['rate'] is None else '{:.1f} {}/s'.format(stage['rate'], stage['unit']),
+                                 '-' if stage['peak_rss_mb'] is None else '{:.1f}'.format(stage['peak_rss_mb'])),
+                  file=file)
+        print(row_fmt.format('total',
+                             '{:.3f}'.format(summary['total_wall_time']),
+                             '{:.3f}'.format(summary['total_cpu_time']),
+                             '', '',
+                             '-' if summary['peak_rss_mb'] is None else '{:.1f}'.format(summary['peak_rss_mb'])),
+              file=file)
+        for name in sorted(self.counters):
+            print("  {:<20} {:>6}".format(name, self.counters[name]), file=file)
+
+    def save(self, filename, **extra):
+        """Save a machine-readable (json) report of the recorded stages, along with any extra information (e.g., the
+        command line arguments)."""
+        with open(filename, 'w') as fp:
+            json.dump(dict(self.summary(), timestamp=time.strftime('%Y-%m-%dT%H:%M:%S%z'), **extra), fp, indent=2)
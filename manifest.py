@@ -0,0 +1,48 @@
+import json
+import os
+# Hashing files is shared with the annotation index cache of the `data` package
+from data.index import sha256sum
+
+# Version of the manifest format (and of the conversion outputs); manifests of a different version are ignored
+MANIFEST_VERSION = 2
+
+
+def file_stat(filename):
+    """Return [size, mtime_ns] of the given file, or None if the file does not exist."""
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+def file_fingerprint(filename, previous=None):
+    """Return the fingerprint (size, modification time, and SHA-256 hash) of the given file. The hash of a `previous`
+    fingerprint of the file is reused if the file's size and modification time have not changed since."""
+    size, mtime_ns = file_stat(filename)
+    if previous is not None and [previous['size'], previous['mtime_ns']] == [size, mtime_ns]:
+        sha256 = previous['sha256']
+    else:
+        sha256 = sha256sum(filename)
+    return {'size': size, 'mtime_ns': mtime_ns, 'sha256': sha256}
+
+
+def load_manifest(filename):
+    """Load a conversion manifest, or return None if it does not exist, it is not valid, or it is of another version."""
+    try:
+        with open(filename, 'r') as fp:
+            manifest = json.load(fp)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(manifest, dict) or manifest.get('version') != MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def save_manifest(filename, manifest):
+    """Save a conversion manifest atomically (i.e., an interrupted run never leaves a partially written manifest)."""
+    manifest = dict(manifest, version=MANIFEST_VERSION)
+    tmp_filename = '{}.tmp'.format(filename)
+    with open(tmp_filename, 'w') as fp:
+        json.dump(manifest, fp)
+    os.replace(tmp_filename, filename)
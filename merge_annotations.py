@@ -1,78 +1,189 @@
 import argparse
 import json
+from coco_io import COCOStreamReader, COCOStreamWriter
+
+# Top-level entries that are not part of the dataset info
+COCO_LIST_KEYS = ('licenses', 'images', 'annotations', 'categories')
+
+
+def merge_info(values):
+    """Merge the values of a dataset info field (e.g., 'description' or 'year') of multiple datasets: strings are joined
+    with ' | ', numbers are reduced to their maximum, and dictionaries (e.g., a standard COCO 'info' entry) are merged
+    field by field."""
+    if all(isinstance(value, dict) for value in values):
+        keys = []
+        for value in values:
+            keys += [key for key in value if key not in keys]
+        return {key: merge_info([value[key] for value in values if key in value]) for key in keys}
+    if all(isinstance(value, str) for value in values):
+        return ' | '.join(values)
+    if all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in values):
+        return max(values)
+    return values[0]
+
+
+class IdRemapper(object):
+    """Assign unique ids to the records (e.g., images) of multiple datasets. A record keeps its id unless it has already
+    been used by a previously added record, in which case it is given the next unused id.
+
+    Only the set of used ids (a hash set) and the ids that have actually been remapped are kept in memory.
+    """
+    def __init__(self):
+        self.used_ids = set()
+        self.next_id = 0
+        self.num_remapped = 0
+
+    def add(self, record_id):
+        """Add a record id and return its (possibly remapped) id."""
+        if record_id in self.used_ids:
+            while self.next_id in self.used_ids:
+                self.next_id += 1
+            new_id = self.next_id
+            self.num_remapped += 1
+        else:
+            new_id = record_id
+        self.used_ids.add(new_id)
+        if isinstance(new_id, int) and new_id >= self.next_id:
+            self.next_id = new_id + 1
+        return new_id
+
+
+def remap_image(image, remapper, license_map, id_map, written):
+    """Remap the id (and license id) of an image record of a dataset.
+
+    An image id is only remapped if it has been used by a previously added dataset (see `IdRemapper`); all records of a
+    dataset with the same image id (e.g., the one record per face written by the original `convert2coco.py`) are given
+    the same id, and identical ones are written once.
+
+    Args:
+        image (dict): image record
+        remapper (IdRemapper): id remapper of the merged images
+        license_map (dict): license id -> merged license id
+        id_map (dict): image id -> merged image id of the dataset, updated in place
+        written (set): hashes of the image records of the dataset written so far, updated in place
+
+    Returns:
+        image (dict): image record to write, or None if an identical one has already been written
+    """
+    if image['id'] not in id_map:
+        id_map[image['id']] = remapper.add(image['id'])
+    image = dict(image, id=id_map[image['id']])
+    if image.get('license') in license_map:
+        image['license'] = license_map[image['license']]
+    key = hash(json.dumps(image, sort_keys=True))
+    if key in written:
+        return None
+    written.add(key)
+    return image
+
+
+def dedup_entries(entries, merged_entries, remapper):
+    """Add the entries (e.g., categories) of a dataset to the merged ones, where identical entries (apart from their id)
+    are kept once.
+
+    Args:
+        entries (list): entries of a dataset
+        merged_entries (dict): merged entries (json-encoded entry without its id -> merged entry), updated in place
+        remapper (IdRemapper): id remapper of the merged entries
+
+    Returns:
+        id_map (dict): entry id -> merged entry id
+    """
+    id_map = dict()
+    for entry in entries:
+        key = json.dumps({k: v for k, v in entry.items() if k != 'id'}, sort_keys=True)
+        if key not in merged_entries:
+            merged_entries[key] = dict(entry, id=remapper.add(entry['id']))
+        id_map[entry['id']] = merged_entries[key]['id']
+    return id_map
 
 
 def main():
     # Set up a parser for command line arguments
-    parser = argparse.ArgumentParser("Concatenate two COCO-style json annotation files")
+    parser = argparse.ArgumentParser("Merge COCO-style json annotation files")
     parser.add_argument('-v', '--verbose', action='store_true', help="increase output verbosity")
-    parser.add_argument('-a', '--first', type=str, required=True, help="set first json annotation file")
-    parser.add_argument('-b', '--second', type=str, required=True, help="set second json annotation file")
+    parser.add_argument('inputs', type=str, nargs='*', help="json annotation files")
+    parser.add_argument('-a', '--first', type=str, help="set first json annotation file")
+    parser.add_argument('-b', '--second', type=str, help="set second json annotation file")
     parser.add_argument('-m', '--merged', type=str, required=True, help="set merged json annotation file")
+    parser.add_argument('--compact', action='store_true',
+                        help="drop empty fields of image and annotation records, and write no whitespace")
+    parser.add_argument('--precision', type=int,
+                        help="round float values (e.g., bounding box coordinates) to the given number of decimal "
+                             "digits")
+    parser.add_argument('--compression', type=str, choices=('auto', 'none', 'gzip', 'xz'), default='auto',
+                        help="compress the merged json annotation file (by default, based on its extension, i.e., .gz "
+                             "for gzip and .xz for xz)")
     args = parser.parse_args()
 
-    # Load first annotation file
-    if args.verbose:
-        print("#. Load first annotation file  : {}".format(args.first))
-
-    with open(args.first, 'r') as f:
-        dict_a = json.load(f)
+    inputs = [filename for filename in (args.first, args.second) if filename] + args.inputs
+    if not inputs:
+        parser.error("no json annotation files given")
 
-    if args.verbose:
-        print("  \\__Number of images         : {}".format(len(dict_a['images'])))
-        print("  \\__Number of annotations    : {}".format(len(dict_a['annotations'])))
-
-    # Load second annotation file
-    if args.verbose:
-        print("#. Load second annotation file : {}".format(args.second))
-
-    with open(args.second, 'r') as f:
-        dict_b = json.load(f)
-
-    if args.verbose:
-        print("  \\__Number of images         : {}".format(len(dict_b['images'])))
-        print("  \\__Number of annotations    : {}".format(len(dict_b['annotations'])))
-
-    # Merge annotation dictionaries
-    if args.verbose:
-        print("#. Merge annotation dictionaries and save at: {}".format(args.merged))
-
-    # Build merged COCO-like dictionary
-    merged_dict = dict()
+    # Read the headers (i.e., dataset info, licenses, and categories) of all annotation files; images and annotations
+    # are skipped without being decoded
+    readers = [COCOStreamReader(filename) for filename in inputs]
+    headers = []
+    for filename, reader in zip(inputs, readers):
+        if args.verbose:
+            print("#. Read annotation file header: {}".format(filename))
+        headers.append(reader.header())
 
     # Dataset info
-    dataset_info = {
-        'description': dict_a['description'] + ' | ' + dict_b['description'],
-        'url': dict_a['url'] + ' | ' + dict_b['url'],
-        'version': dict_a['version'] + ' | ' + dict_b['version'],
-        'year': max(dict_a['year'], dict_b['year']),
-        'contributor': dict_a['contributor'] + ' | ' + dict_b['contributor'],
-        'date_created': dict_a['date_created'] + ' | ' + dict_b['date_created']
-    }
-    merged_dict.update(dataset_info)
-
-    # Dataset licenses
-    dataset_licenses = {'licenses': dict_a['licenses'] + dict_b['licenses']}
-    merged_dict.update(dataset_licenses)
-
-    # Dataset images
-    dataset_images = {'images': dict_a['images'] + dict_b['images']}
-    merged_dict.update(dataset_images)
-
-    # Dataset annotations
-    dataset_annotations = {'annotations': dict_a['annotations'] + dict_b['annotations']}
-    merged_dict.update(dataset_annotations)
-
-    # Dataset categories
-    dataset_categories = {'categories': dict_a['categories'] + dict_b['categories']}
-    merged_dict.update(dataset_categories)
-
+    info_keys = []
+    for header in headers:
+        info_keys += [key for key in header if key not in COCO_LIST_KEYS and key not in info_keys]
+    merged_header = {key: merge_info([header[key] for header in headers if key in header]) for key in info_keys}
+
+    # Dataset licenses and categories: identical entries are kept once
+    merged_licenses, license_remapper = dict(), IdRemapper()
+    merged_categories, category_remapper = dict(), IdRemapper()
+    license_maps = [dedup_entries(header.get('licenses', []), merged_licenses, license_remapper) for header in headers]
+    category_maps = [dedup_entries(header.get('categories', []), merged_categories, category_remapper)
+                     for header in headers]
+    merged_header['licenses'] = list(merged_licenses.values())
+
+    # Merge images and annotations, one record at a time
     if args.verbose:
-        print("  \\__Number of images         : {}".format(len(merged_dict['images'])))
-        print("  \\__Number of annotations    : {}".format(len(merged_dict['annotations'])))
+        print("#. Merge annotation files and save at: {}".format(args.merged))
+    image_remapper, annotation_remapper = IdRemapper(), IdRemapper()
+    with COCOStreamWriter(args.merged, header=merged_header,
+                          footer={'categories': list(merged_categories.values())},
+                          compact=args.compact, precision=args.precision, compression=args.compression) as writer:
+        for filename, reader, license_map, category_map in zip(inputs, readers, license_maps, category_maps):
+            num_images, num_annotations = writer.num_images, writer.num_annotations
+            image_id_map, written_images = dict(), set()
+            # Images and annotations are read in a single pass over the file, unless annotations come first (their
+            # image ids are only known once all images have been remapped)
+            keys = reader.keys
+            if 'annotations' in keys and 'images' in keys and keys.index('annotations') < keys.index('images'):
+                passes = [('images',), ('annotations',)]
+            else:
+                passes = [('images', 'annotations')]
+            for stream_keys in passes:
+                for key, record in reader.iter_streams(stream_keys):
+                    if key == 'images':
+                        image = remap_image(record, image_remapper, license_map, image_id_map, written_images)
+                        if image is not None:
+                            writer.add_image(image)
+                        continue
+                    annotation = dict(record,
+                                      id=annotation_remapper.add(record['id']),
+                                      image_id=image_id_map.get(record['image_id'], record['image_id']))
+                    if annotation.get('category_id') in category_map:
+                        annotation['category_id'] = category_map[annotation['category_id']]
+                    writer.add_annotation(annotation)
+            if args.verbose:
+                print("  \\__{}: {} images, {} annotations".format(filename, writer.num_images - num_images,
+                                                                  writer.num_annotations - num_annotations))
 
-    with open(args.merged, 'w') as fp:
-        json.dump(merged_dict, fp)
+    if args.verbose:
+        print("  \\__Number of images         : {} (remapped ids: {})".format(writer.num_images,
+                                                                           image_remapper.num_remapped))
+        print("  \\__Number of annotations    : {} (remapped ids: {})".format(writer.num_annotations,
+                                                                           annotation_remapper.num_remapped))
+        print("  \\__Number of categories     : {}".format(len(merged_categories)))
+        print("  \\__Number of licenses       : {}".format(len(merged_licenses)))
 
 
 if __name__ == '__main__':
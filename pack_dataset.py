@@ -0,0 +1,282 @@
+import argparse
+import os
+import os.path as osp
+import numpy as np
+import cv2
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
+from data.aflw import IMREAD_FLAGS
+from data.bundle import create_bundle_array, get_bundle_path, load_bundle, save_bundle
+from data.faces import crop_keypoints, extract_crops, get_crop_boxes
+from data.store import AnnotationStore
+from instrumentation import ProgressReporter
+
+
+def get_resize_geometry(heights, widths, size, letterbox=False):
+    """Get the geometry of resizing images to `size` x `size`, i.e., either stretching them, or scaling them (keeping
+    their aspect ratio) so that their longer side is `size` and padding the shorter one evenly on both sides
+    (letterboxing).
+
+    Args:
+        heights (np.ndarray): image heights
+        widths (np.ndarray): image widths
+        size (int): output image size
+        letterbox (bool): keep the aspect ratio of images
+
+    Returns:
+        geometry (np.ndarray): (N, 4) array of [resized width, resized height, x padding, y padding] rows
+    """
+    heights, widths = np.asarray(heights, dtype=np.float64), np.asarray(widths, dtype=np.float64)
+    if not letterbox:
+        return np.tile(np.array([size, size, 0, 0], dtype=np.int64), (len(heights), 1))
+    scales = size / np.maximum(heights, widths)
+    new_widths = np.clip(np.round(widths * scales), 1, size).astype(np.int64)
+    new_heights = np.clip(np.round(heights * scales), 1, size).astype(np.int64)
+    return np.stack((new_widths, new_heights, (size - new_widths) // 2, (size - new_heights) // 2), axis=1)
+
+
+def rescale_points(points, geometry, size):
+    """Map (N, P, 2) x, y coordinates, normalized by the original image size, onto the resized images, where `geometry`
+    is the (N, 4) resize geometry of the image of each row (see `get_resize_geometry()`)."""
+    return (points * geometry[:, None, :2] + geometry[:, None, 2:]) / size
+
+
+# Worker state, set up once per worker process
+_worker = None
+
+
+def _init_resized_worker(dataset_root, json_file, pack_dir, size, pad_value):
+    global _worker
+    _worker = {'root': dataset_root,
+               'store': AnnotationStore.from_json(json_file),
+               'images': np.load(osp.join(pack_dir, 'images.npy'), mmap_mode='r+'),
+               'size': size,
+               'pad_value': pad_value}
+
+
+def _pack_resized(task):
+    """Decode the index-th image, resize it according to its geometry, and write it into the packed images array."""
+    index, (new_w, new_h, pad_x, pad_y) = task
+    img = cv2.imread(osp.join(_worker['root'], _worker['store'].image_path(index)), IMREAD_FLAGS)
+    if img is None:
+        return index, False
+    img = cv2.resize(img, (int(new_w), int(new_h)))
+    out = _worker['images'][index]
+    if new_w != _worker['size'] or new_h != _worker['size']:
+        out[...] = _worker['pad_value']
+    out[pad_y:pad_y + new_h, pad_x:pad_x + new_w] = img
+    return index, True
+
+
+def pack_resized(args):
+    """Decode each image once, resize (or letterbox) it to `--size` x `--size`, and write all images into a single uint8
+    memory-mapped array, along with the detection targets (and keypoints) rescaled to match."""
+    json_file = osp.join(args.dataset_root, args.json) if not osp.isfile(args.json) else args.json
+    store = AnnotationStore.from_json(json_file)
+    num_images = len(store)
+    if args.verbose:
+        print("#. Pack AFLW images resized to {0}x{0}{1}: {2}".format(
+            args.size, ' (letterboxed)' if args.letterbox else '', args.output))
+        print("  \\__Number of images: {}".format(num_images))
+
+    geometry = get_resize_geometry(store.heights, store.widths, args.size, args.letterbox)
+    box_geometry = np.repeat(geometry, np.diff(store.box_offsets), axis=0)
+    targets = np.array(store.targets)
+    targets[:, :4] = rescale_points(targets[:, :4].reshape(-1, 2, 2), box_geometry, args.size).reshape(-1, 4)
+    arrays = {'image_ids': np.array(store.image_ids),
+              'heights': np.array(store.heights),
+              'widths': np.array(store.widths),
+              'geometry': geometry,
+              'box_offsets': np.array(store.box_offsets),
+              'targets': targets.astype(np.float32)}
+    if store.keypoints is not None:
+        keypoints = np.array(store.keypoints)
+        keypoints[:, :, :2] = rescale_points(keypoints[:, :, :2], box_geometry, args.size)
+        arrays['keypoints'] = keypoints.astype(np.float32)
+
+    # Decode and resize images in parallel; each worker writes its images straight into the memory-mapped array
+    arrays['images'] = create_bundle_array(args.output, 'images', (num_images, args.size, args.size, 3), np.uint8)
+    valid = np.zeros(num_images, dtype=np.bool_)
+    progress = ProgressReporter("  \\__Resize images...", num_images, name='pack_resized', unit='images') \
+        if args.verbose and num_images else None
+    tasks = list(enumerate(geometry))
+    with Pool(args.workers, initializer=_init_resized_worker,
+              initargs=(args.dataset_root, json_file, args.output, args.size, args.pad_value)) as pool:
+        chunksize = max(1, min(64, num_images // (8 * args.workers)))
+        for cnt, (index, ok) in enumerate(pool.imap_unordered(_pack_resized, tasks, chunksize=chunksize)):
+            valid[index] = ok
+            if progress is not None:
+                progress.update(cnt + 1)
+    arrays['valid'] = valid
+    save_bundle(args.output, arrays, kind='resized', size=args.size, letterbox=args.letterbox,
+                pad_value=args.pad_value, json=osp.basename(args.json))
+
+    if args.verbose:
+        print("  \\__Images that could not be read: {}".format(int((~valid).sum())))
+        print("  \\__Packed images size: {:.1f} MB".format(arrays['images'].nbytes / 2 ** 20))
+
+
+def read_file(filename):
+    try:
+        with open(filename, 'rb') as fp:
+            return fp.read()
+    except OSError:
+        return None
+
+
+def pack_shards(args):
+    """Concatenate the encoded bytes of all images (in dataset order) into a few large shard files, along with an offset
+    index, i.e., the shard, offset, and length of each image (see `data.shards.ImageShards`)."""
+    json_file = osp.join(args.dataset_root, args.json) if not osp.isfile(args.json) else args.json
+    store = AnnotationStore.from_json(json_file)
+    num_images = len(store)
+    if args.verbose:
+        print("#. Pack AFLW images into shards of up to {} MB: {}".format(args.shard_mb, args.output))
+        print("  \\__Number of images: {}".format(num_images))
+    if not osp.isdir(args.output):
+        os.makedirs(args.output)
+
+    shard_ids = np.zeros(num_images, dtype=np.int32)
+    offsets = np.zeros(num_images, dtype=np.int64)
+    lengths = np.zeros(num_images, dtype=np.int64)
+    shards = []
+    shard_fp = None
+    progress = ProgressReporter("  \\__Pack images...", num_images, name='pack_shards', unit='images') \
+        if args.verbose and num_images else None
+    # Image files are read ahead by a thread pool (a bounded window of files at a time), and appended to the current
+    # shard in order; a new shard is started once the current one would exceed the maximum shard size
+    max_shard_bytes = args.shard_mb * 2 ** 20
+    window = 64 * max(1, args.workers)
+    with ThreadPoolExecutor(max(1, args.workers)) as pool:
+        for start in range(0, num_images, window):
+            paths = [osp.join(args.dataset_root, store.image_path(index))
+                     for index in range(start, min(start + window, num_images))]
+            for index, img_bytes in enumerate(pool.map(read_file, paths), start):
+                if img_bytes:
+                    if shard_fp is None or 0 < shard_fp.tell() and shard_fp.tell() + len(img_bytes) > max_shard_bytes:
+                        if shard_fp is not None:
+                            shard_fp.close()
+                        shards.append('shard{:05d}.bin'.format(len(shards)))
+                        shard_fp = open(osp.join(args.output, shards[-1]), 'wb')
+                    shard_ids[index] = len(shards) - 1
+                    offsets[index] = shard_fp.tell()
+                    lengths[index] = len(img_bytes)
+                    shard_fp.write(img_bytes)
+                if progress is not None:
+                    progress.update(index + 1)
+    if shard_fp is not None:
+        shard_fp.close()
+
+    save_bundle(args.output, {'image_ids': np.array(store.image_ids),
+                              'shard_ids': shard_ids,
+                              'offsets': offsets,
+                              'lengths': lengths},
+                kind='shards', shards=shards, json=osp.basename(args.json))
+
+    if args.verbose:
+        print("  \\__Images that could not be read: {}".format(int((lengths == 0).sum())))
+        print("  \\__Number of shards: {} ({:.1f} MB)".format(len(shards), lengths.sum() / 2 ** 20))
+
+
+def _init_crops_worker(dataset_root, bundle_dir, pack_dir, size, scale, pad_value):
+    global _worker
+    bundle, _ = load_bundle(bundle_dir)
+    _worker = {'root': dataset_root,
+               'bundle': bundle,
+               'crop_boxes': get_crop_boxes(bundle['boxes'], scale),
+               'crops': np.load(osp.join(pack_dir, 'crops.npy'), mmap_mode='r+'),
+               'size': size,
+               'pad_value': pad_value}
+
+
+def _pack_crops(image_index):
+    """Decode the image_index-th image once, and write the crops of all its faces into the packed crops array."""
+    bundle = _worker['bundle']
+    faces = slice(int(bundle['face_offsets'][image_index]), int(bundle['face_offsets'][image_index + 1]))
+    crops = extract_crops(osp.join(_worker['root'], get_bundle_path(bundle, image_index)), _worker['crop_boxes'][faces],
+                          int(bundle['heights'][image_index]), int(bundle['widths'][image_index]), _worker['size'],
+                          _worker['pad_value'], out=_worker['crops'][faces])
+    return image_index, crops is not None
+
+
+def pack_crops(args):
+    """Decode each image once, extract a square crop around each of its faces (see `data.faces.get_crop_boxes()`),
+    resized to `--size` x `--size`, and write all crops into a single uint8 memory-mapped array, along with the
+    keypoints (normalized by the crop) and head pose of each face (see `data.faces.AFLWFaces`)."""
+    bundle, _ = load_bundle(args.bundle)
+    num_images, num_faces = len(bundle['image_ids']), len(bundle['face_ids'])
+    if args.verbose:
+        print("#. Pack AFLW face crops ({0}x{0}, scale {1}): {2}".format(args.size, args.scale, args.output))
+        print("  \\__Number of images: {}".format(num_images))
+        print("  \\__Number of faces: {}".format(num_faces))
+
+    crop_boxes = get_crop_boxes(bundle['boxes'], args.scale)
+    arrays = {'face_ids': np.array(bundle['face_ids']),
+              'crop_boxes': crop_boxes,
+              'keypoints': crop_keypoints(bundle['keypoints'], crop_boxes),
+              'pose': np.array(bundle['pose'])}
+
+    # Extract crops in parallel (one task per image); each worker writes its crops straight into the memory-mapped array
+    arrays['crops'] = create_bundle_array(args.output, 'crops', (num_faces, args.size, args.size, 3), np.uint8)
+    valid = np.zeros(num_faces, dtype=np.bool_)
+    progress = ProgressReporter("  \\__Extract crops...", num_images, name='pack_crops', unit='images') \
+        if args.verbose and num_images else None
+    with Pool(args.workers, initializer=_init_crops_worker,
+              initargs=(args.dataset_root, args.bundle, args.output, args.size, args.scale, args.pad_value)) as pool:
+        chunksize = max(1, min(64, num_images // (8 * args.workers)))
+        for cnt, (image_index, ok) in enumerate(pool.imap_unordered(_pack_crops, range(num_images),
+                                                                    chunksize=chunksize)):
+            valid[bundle['face_offsets'][image_index]:bundle['face_offsets'][image_index + 1]] = ok
+            if progress is not None:
+                progress.update(cnt + 1)
+    arrays['valid'] = valid
+    save_bundle(args.output, arrays, kind='crops', size=args.size, scale=args.scale, pad_value=args.pad_value,
+                bundle=osp.basename(osp.normpath(args.bundle)))
+
+    if args.verbose:
+        print("  \\__Faces whose image could not be read: {}".format(int((~valid).sum())))
+        print("  \\__Packed crops size: {:.1f} MB".format(arrays['crops'].nbytes / 2 ** 20))
+
+
+def main():
+    # Set up a parser for command line arguments
+    parser = argparse.ArgumentParser("Pack AFLW dataset's images for fast loading")
+    parser.add_argument('-v', '--verbose', action='store_true', help="increase output verbosity")
+    parser.add_argument('--dataset_root', type=str, required=True, help='AFLW root directory')
+    parser.add_argument('--json', type=str, default='aflw_annotations.json', help="COCO json annotation file")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="number of worker processes")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    resized_parser = subparsers.add_parser('resized', help="pack images resized to a fixed size into a single memory-"
+                                                           "mapped uint8 array")
+    resized_parser.add_argument('-o', '--output', type=str, required=True, help="output directory")
+    resized_parser.add_argument('--size', type=int, default=300, help="output image size (width and height)")
+    resized_parser.add_argument('--letterbox', action='store_true',
+                                help="keep the aspect ratio of images, padding their shorter side")
+    resized_parser.add_argument('--pad_value', type=int, default=0, help="value of letterbox padding")
+    resized_parser.set_defaults(func=pack_resized)
+
+    shards_parser = subparsers.add_parser('shards', help="pack encoded images into a few large shard files with an "
+                                                         "offset index")
+    shards_parser.add_argument('-o', '--output', type=str, required=True, help="output directory")
+    shards_parser.add_argument('--shard_mb', type=int, default=1024, help="maximum size (in MB) of each shard file")
+    shards_parser.set_defaults(func=pack_shards)
+
+    crops_parser = subparsers.add_parser('crops', help="pack a square crop around each face, along with its keypoints "
+                                                       "and head pose, into a single memory-mapped uint8 array")
+    crops_parser.add_argument('-o', '--output', type=str, required=True, help="output directory")
+    crops_parser.add_argument('--bundle', type=str, required=True,
+                              help="annotation bundle directory (see convert2coco.py --bundle)")
+    crops_parser.add_argument('--size', type=int, default=128, help="crop size (width and height)")
+    crops_parser.add_argument('--scale', type=float, default=1.5,
+                              help="crop side over the longer side of the face bounding box")
+    crops_parser.add_argument('--pad_value', type=int, default=0, help="value of padding outside the image")
+    crops_parser.set_defaults(func=pack_crops)
+    args = parser.parse_args()
+
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
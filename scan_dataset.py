@@ -0,0 +1,148 @@
+import argparse
+import os
+import os.path as osp
+import json
+from multiprocessing import Pool
+from PIL import Image
+from coco_io import load_json
+from instrumentation import ProgressReporter
+
+
+def scan_image(task):
+    """Fully decode an image and check its annotations.
+
+    Args:
+        task (tuple): (image id, dataset root, image file name, annotated width, annotated height,
+                       list of (annotation id, bbox))
+
+    Returns:
+        result (dict): scan result, where 'status' is one of
+                       'ok'            : image decoded and all bounding boxes lie within the image,
+                       'missing'       : image file does not exist,
+                       'corrupt'       : image file could not be decoded (e.g., it is truncated),
+                       'size_mismatch' : decoded image size differs from the annotated one,
+                       'bbox_out_of_bounds' : some bounding boxes (see 'bbox_out_of_bounds') do not lie within the image
+    """
+    image_id, root, file_name, width, height, bboxes = task
+    image_file = osp.join(root, file_name)
+    result = {'image_id': image_id, 'file_name': file_name, 'status': 'ok'}
+    if not osp.isfile(image_file):
+        result['status'] = 'missing'
+        return result
+    try:
+        with Image.open(image_file) as im:
+            im.load()
+            img_w, img_h = im.size
+    except Exception as e:
+        result['status'] = 'corrupt'
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+        return result
+    if (img_w, img_h) != (width, height):
+        result['status'] = 'size_mismatch'
+        result['size'] = [img_w, img_h]
+        return result
+    out_of_bounds = [ann_id for ann_id, (x, y, w, h) in bboxes
+                     if x < 0 or y < 0 or w <= 0 or h <= 0 or x + w > img_w or y + h > img_h]
+    if out_of_bounds:
+        result['status'] = 'bbox_out_of_bounds'
+        result['bbox_out_of_bounds'] = out_of_bounds
+    return result
+
+
+def load_checkpoint(checkpoint_file):
+    """Load the results of a previous (interrupted) scan, i.e., one json-encoded result per line. A partially written
+    last line is truncated, so that new results can be appended to the checkpoint file."""
+    results = dict()
+    if not osp.isfile(checkpoint_file):
+        return results
+    valid_size = 0
+    with open(checkpoint_file, 'rb') as fp:
+        for line in fp:
+            try:
+                result = json.loads(line.decode('utf-8'))
+            except ValueError:
+                break
+            if not line.endswith(b'\n'):
+                break
+            results[result['image_id']] = result
+            valid_size += len(line)
+    with open(checkpoint_file, 'r+b') as fp:
+        fp.truncate(valid_size)
+    return results
+
+
+def main():
+    # Set up a parser for command line arguments
+    parser = argparse.ArgumentParser("Scan AFLW dataset's images for missing/corrupt files and invalid annotations")
+    parser.add_argument('-v', '--verbose', action='store_true', help="increase output verbosity")
+    parser.add_argument('--dataset_root', type=str, required=True, help='AFLW root directory')
+    parser.add_argument('--json', type=str, default='aflw_annotations.json', help="COCO json annotation file")
+    parser.add_argument('--report', type=str, default='scan_report.json', help="output scan report (json) file")
+    parser.add_argument('--checkpoint', type=str,
+                        help="checkpoint file, used for resuming an interrupted scan (by default <report>.checkpoint)")
+    parser.add_argument('--restart', action='store_true', help="ignore the checkpoint of a previous scan")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="number of worker processes")
+    args = parser.parse_args()
+
+    checkpoint_file = args.checkpoint or '{}.checkpoint'.format(args.report)
+
+    # Load annotations
+    if args.verbose:
+        print("#. Scan AFLW dataset...")
+        print("  \\__Load annotation file: {}".format(args.json))
+    dataset_dict = load_json(osp.join(args.dataset_root, args.json) if not osp.isfile(args.json) else args.json)
+    bboxes = dict()
+    for ann in dataset_dict['annotations']:
+        bboxes.setdefault(ann['image_id'], []).append((ann['id'], ann['bbox']))
+    tasks = [(img['id'], args.dataset_root, img['file_name'], img['width'], img['height'], bboxes.get(img['id'], []))
+             for img in dataset_dict['images']]
+    del dataset_dict, bboxes
+
+    # Resume from checkpoint (if any)
+    if args.restart and osp.isfile(checkpoint_file):
+        os.remove(checkpoint_file)
+    task_image_ids = set(task[0] for task in tasks)
+    results = {image_id: result for image_id, result in load_checkpoint(checkpoint_file).items()
+               if image_id in task_image_ids}
+    pending_tasks = [task for task in tasks if task[0] not in results]
+    if args.verbose:
+        print("  \\__Number of images: {} (already scanned: {})".format(len(tasks), len(tasks) - len(pending_tasks)))
+
+    # Scan pending images; each result is appended to the checkpoint file as soon as it is available
+    if pending_tasks:
+        progress = ProgressReporter("  \\__Scan images...", len(tasks), name='scan', unit='images') \
+            if args.verbose else None
+        with open(checkpoint_file, 'a') as checkpoint, Pool(args.workers) as pool:
+            chunksize = max(1, min(64, len(pending_tasks) // (8 * args.workers)))
+            for result in pool.imap_unordered(scan_image, pending_tasks, chunksize=chunksize):
+                results[result['image_id']] = result
+                checkpoint.write('{}\n'.format(json.dumps(result)))
+                if progress is not None:
+                    progress.update(len(results))
+            checkpoint.flush()
+
+    # Write report
+    status_counts = dict()
+    for result in results.values():
+        status_counts[result['status']] = status_counts.get(result['status'], 0) + 1
+    report = {'json': args.json,
+              'dataset_root': osp.abspath(args.dataset_root),
+              'num_images': len(tasks),
+              'status_counts': status_counts,
+              'issues': sorted((result for result in results.values() if result['status'] != 'ok'),
+                               key=lambda result: result['file_name'])}
+    with open(args.report, 'w') as fp:
+        json.dump(report, fp, indent=2)
+
+    # The scan is complete, so the checkpoint is no longer needed
+    if osp.isfile(checkpoint_file):
+        os.remove(checkpoint_file)
+
+    if args.verbose:
+        for status in sorted(status_counts):
+            print("  \\__{:<20}: {}".format(status, status_counts[status]))
+        print("  \\__Save scan report: {}".format(args.report))
+
+
+if __name__ == "__main__":
+    main()
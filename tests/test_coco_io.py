@@ -0,0 +1,121 @@
+import json
+import pytest
+from coco_io import COCOStreamReader, COCOStreamWriter, format_record, load_json, save_json
+
+CHUNK_SIZES = [1, 2, 3, 7, 64, 1 << 20]
+
+
+def make_dataset(num_images=5):
+    images = [{'id': i + 1, 'file_name': 'flickr/0/image{:05d}.jpg'.format(i), 'height': 480, 'width': 640.5,
+               'flickr_url': ''} for i in range(num_images)]
+    annotations = [{'id': 100 + i, 'image_id': i + 1, 'bbox': [1.25, -2e-3, 31.999, 1e10], 'keypoints': [0, 0, 0],
+                    'category_id': 0, 'iscrowd': False, 'note': None} for i in range(num_images)]
+    # Strings with brackets, braces, quotes, escapes, and non-ascii characters, which the reader scans for when
+    # skipping entries
+    images[0]['file_name'] = 'we"ird]}/[{ \\ name é中.jpg'
+    return {'info': {'description': 'AFLW "faces" ]}', 'nested': [[], {}, [{'a': '\\"'}]]},
+            'licenses': [{'id': 1, 'name': 'CC', 'url': ''}],
+            'images': images,
+            'annotations': annotations,
+            'categories': [{'id': 0, 'name': 'face', 'keypoints': ['a', 'b']}],
+            'year': 2011}
+
+
+def write_json(path, dataset_dict, compact=False, compression='auto'):
+    save_json(dataset_dict, str(path), compact=compact, compression=compression)
+    return str(path)
+
+
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+@pytest.mark.parametrize('filename, compact', [('a.json', False), ('a.json', True), ('a.json.gz', False)])
+def test_reader(tmp_path, chunk_size, filename, compact):
+    dataset = make_dataset()
+    reader = COCOStreamReader(write_json(tmp_path / filename, dataset, compact=compact), chunk_size=chunk_size)
+    for key in ('images', 'annotations'):
+        dataset[key] = [format_record(record, compact=compact) for record in dataset[key]]
+    assert reader.header() == {key: value for key, value in dataset.items() if key not in ('images', 'annotations')}
+    assert reader.keys == list(dataset)
+    assert list(reader.iter_records('images')) == dataset['images']
+    assert list(reader.iter_records('annotations')) == dataset['annotations']
+    assert list(reader.iter_streams(('images', 'annotations'))) == \
+        [('images', image) for image in dataset['images']] + \
+        [('annotations', annotation) for annotation in dataset['annotations']]
+
+
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+def test_reader_empty_lists(tmp_path, chunk_size):
+    dataset = {'images': [], 'annotations': [], 'categories': []}
+    reader = COCOStreamReader(write_json(tmp_path / 'a.json', dataset), chunk_size=chunk_size)
+    assert reader.header() == {'categories': []}
+    assert list(reader.iter_streams(('images', 'annotations'))) == []
+    reader = COCOStreamReader(write_json(tmp_path / 'b.json', {}), chunk_size=chunk_size)
+    assert reader.header() == {}
+    assert list(reader.iter_records('images')) == []
+
+
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+def test_reader_numbers_across_chunks(tmp_path, chunk_size):
+    # Numbers that are split across chunks (e.g., '1' of '12.5e-3') are decoded whole
+    path = tmp_path / 'a.json'
+    path.write_text('{"images": [12.5e-3, 123456789, -0.75, 1E+2], "annotations": [], "year": 2011}')
+    reader = COCOStreamReader(str(path), chunk_size=chunk_size)
+    assert list(reader.iter_records('images')) == [12.5e-3, 123456789, -0.75, 1e2]
+    assert reader.header() == {'year': 2011}
+
+
+def test_reader_decodes_records_once(tmp_path):
+    class CountingDecoder(json.JSONDecoder):
+        num_decoded = 0
+
+        def raw_decode(self, s, idx=0):
+            CountingDecoder.num_decoded += 1
+            return super(CountingDecoder, self).raw_decode(s, idx)
+
+    dataset = make_dataset(num_images=50)
+    reader = COCOStreamReader(write_json(tmp_path / 'a.json', dataset))
+    reader.decoder = CountingDecoder()
+    # Images and annotations are skipped without being decoded when reading the header
+    reader.header()
+    assert CountingDecoder.num_decoded < 50
+    # Reading stops once the images have been read
+    CountingDecoder.num_decoded = 0
+    assert len(list(reader.iter_records('images'))) == 50
+    assert CountingDecoder.num_decoded < 50 + 10
+    CountingDecoder.num_decoded = 0
+    assert len(list(reader.iter_streams(('images', 'annotations')))) == 100
+    assert CountingDecoder.num_decoded < 100 + 10
+
+
+@pytest.mark.parametrize('text', ['', '[]', '{"images": [1, 2', '{"images": [1 2]}', '{"info": {"a": "b"', '{"a": 1'])
+def test_reader_invalid(tmp_path, text):
+    path = tmp_path / 'a.json'
+    path.write_text(text)
+    reader = COCOStreamReader(str(path), chunk_size=4)
+    with pytest.raises(ValueError):
+        # Skipped entries are only scanned, so they are validated when their records are read
+        reader.header()
+        list(reader.iter_streams(('images', 'annotations')))
+
+
+def test_reader_invalid_key(tmp_path):
+    reader = COCOStreamReader(write_json(tmp_path / 'a.json', make_dataset()))
+    with pytest.raises(ValueError):
+        list(reader.iter_records('categories'))
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_writer(tmp_path, compact):
+    # The streamed output is identical to the one of `save_json()`
+    dataset = make_dataset()
+    header = {key: dataset[key] for key in ('info', 'licenses')}
+    footer = {key: dataset[key] for key in ('categories', 'year')}
+    with COCOStreamWriter(str(tmp_path / 'streamed.json'), header=header, footer=footer, compact=compact) as writer:
+        for image in dataset['images']:
+            writer.add_image(image)
+        for annotation in dataset['annotations']:
+            writer.add_annotation(annotation)
+    save_json(dict(header, images=dataset['images'], annotations=dataset['annotations'], **footer),
+              str(tmp_path / 'saved.json'), compact=compact)
+    assert (tmp_path / 'streamed.json').read_text() == (tmp_path / 'saved.json').read_text()
+    assert writer.num_images == writer.num_annotations == 5
+    assert load_json(str(tmp_path / 'streamed.json'))['images'][0]['file_name'] == dataset['images'][0]['file_name']
@@ -0,0 +1,52 @@
+import json
+import multiprocessing
+import os.path as osp
+import numpy as np
+import cv2
+import pytest
+import torch.utils.data as data
+from data import AFLW, BaseTransform, ReadAheadSampler, detection_collate
+
+# Batches that are not loaded within this time (in seconds) are taken as hung workers
+TIMEOUT = 30
+
+pytestmark = pytest.mark.skipif('fork' not in multiprocessing.get_all_start_methods(),
+                                reason="fork start method is not available")
+
+
+def make_dataset(root, num_images=8, height=48, width=64):
+    """Write a small COCO-style dataset (synthetic images, one face each) into `root`, returning its json file name."""
+    rng = np.random.RandomState(0)
+    images, annotations = [], []
+    for i in range(num_images):
+        file_name = 'image{:05d}.jpg'.format(i)
+        cv2.imwrite(osp.join(root, file_name), rng.randint(0, 256, (height, width, 3), dtype=np.uint8))
+        images.append({'id': i + 1, 'file_name': file_name, 'height': height, 'width': width})
+        annotations.append({'id': i + 1, 'image_id': i + 1, 'bbox': [4, 4, 16, 16], 'category_id': 0})
+    with open(osp.join(root, 'annotations.json'), 'w') as fp:
+        json.dump({'images': images, 'annotations': annotations, 'categories': [{'id': 0, 'name': 'face'}]}, fp)
+    return 'annotations.json'
+
+
+def load_epochs(dataset, sampler=None, epochs=2):
+    loader = data.DataLoader(dataset, batch_size=4, sampler=sampler, num_workers=2, collate_fn=detection_collate,
+                             multiprocessing_context='fork', timeout=TIMEOUT)
+    for _ in range(epochs):
+        for images, targets in loader:
+            assert images.shape == (4, 3, 32, 32)
+            assert len(targets) == 4
+
+
+def test_batch_threads_forked_after_batch(tmp_path):
+    root = str(tmp_path)
+    dataset = AFLW(root, make_dataset(root), transform=BaseTransform(32, (104, 117, 123)), batch_threads=2)
+    # The batch thread pool is created in this process before workers are forked
+    assert len(dataset.__getitems__([0, 1, 2, 3])) == 4
+    load_epochs(dataset)
+
+
+def test_prefetcher_forked_after_read_ahead(tmp_path):
+    root = str(tmp_path)
+    dataset = AFLW(root, make_dataset(root), transform=BaseTransform(32, (104, 117, 123)), read_ahead=4)
+    # Workers of the second epoch are forked after the first epoch has been read ahead in this process
+    load_epochs(dataset, ReadAheadSampler(data.SequentialSampler(dataset), dataset.prefetcher))
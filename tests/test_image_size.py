@@ -0,0 +1,81 @@
+import pytest
+from PIL import Image
+from image_size import get_img_size, get_img_size_header
+
+
+def save_image(path, size=(123, 45), mode='RGB', **kwargs):
+    Image.new(mode, size).save(path, **kwargs)
+    return path
+
+
+def jpeg_sof_offset(data):
+    """Offset of the first start-of-frame marker of JPEG bytes (baseline or progressive)."""
+    return min(offset for offset in (data.find(b'\xff\xc0'), data.find(b'\xff\xc2')) if offset >= 0)
+
+
+@pytest.mark.parametrize('mode, kwargs', [
+    ('RGB', {}),
+    ('RGB', {'progressive': True}),
+    ('L', {}),
+    ('CMYK', {}),
+])
+def test_jpeg(tmp_path, mode, kwargs):
+    path = save_image(str(tmp_path / 'image.jpg'), mode=mode, quality=90, **kwargs)
+    assert get_img_size_header(path) == (123, 45)
+
+
+def test_jpeg_exif(tmp_path):
+    # EXIF (and other application) segments before the start-of-frame segment are skipped
+    exif = Image.Exif()
+    exif[0x010e] = 'x' * 20000  # ImageDescription
+    path = save_image(str(tmp_path / 'image.jpg'), size=(640, 480), exif=exif, progressive=True)
+    assert get_img_size_header(path) == (640, 480)
+
+
+def test_jpeg_fill_bytes(tmp_path):
+    # Markers may be preceded by any number of 0xFF fill bytes
+    path = save_image(str(tmp_path / 'image.jpg'))
+    with open(path, 'rb') as fp:
+        data = fp.read()
+    sof = jpeg_sof_offset(data)
+    with open(path, 'wb') as fp:
+        fp.write(data[:sof] + b'\xff' * 7 + data[sof:])
+    assert get_img_size_header(path) == (123, 45)
+
+
+@pytest.mark.parametrize('end', [2, 3, 5, 'sof', 'sof+4', 'sof+8'])
+def test_jpeg_truncated(tmp_path, end):
+    path = save_image(str(tmp_path / 'image.jpg'))
+    with open(path, 'rb') as fp:
+        data = fp.read()
+    if isinstance(end, str):
+        end = jpeg_sof_offset(data) + (int(end[4:]) if '+' in end else 0)
+    with open(path, 'wb') as fp:
+        fp.write(data[:end])
+    assert get_img_size_header(path) is None
+
+
+def test_png(tmp_path):
+    path = save_image(str(tmp_path / 'image.png'))
+    assert get_img_size_header(path) == (123, 45)
+    with open(path, 'rb') as fp:
+        data = fp.read()
+    with open(path, 'wb') as fp:
+        fp.write(data[:20])
+    assert get_img_size_header(path) is None
+
+
+def test_other_formats(tmp_path):
+    path = save_image(str(tmp_path / 'image.bmp'))
+    assert get_img_size_header(path) is None
+    # Other formats are read by PIL
+    assert get_img_size(path) == (123, 45)
+    assert get_img_size(save_image(str(tmp_path / 'image.jpg')), backend='pil') == (123, 45)
+    with pytest.raises(ValueError):
+        get_img_size(path, backend='unknown')
+
+
+def test_empty_file(tmp_path):
+    path = str(tmp_path / 'empty.jpg')
+    open(path, 'wb').close()
+    assert get_img_size_header(path) is None
@@ -0,0 +1,83 @@
+import sys
+import pytest
+from coco_io import load_json, save_json
+import merge_annotations
+from merge_annotations import IdRemapper, dedup_entries, merge_info, remap_image
+
+
+def test_id_remapper():
+    remapper = IdRemapper()
+    assert [remapper.add(record_id) for record_id in (1, 2, 5)] == [1, 2, 5]
+    # Colliding ids (including ones given to previously remapped ids) are given the next unused id
+    assert [remapper.add(record_id) for record_id in (1, 2, 3, 7)] == [6, 7, 3, 8]
+    assert remapper.num_remapped == 3
+    assert remapper.add(6) == 9
+
+
+def test_remap_image():
+    remapper = IdRemapper()
+    license_map = {1: 10}
+    id_map, written = dict(), set()
+    image = {'id': 1, 'file_name': 'a.jpg', 'license': 1}
+    assert remap_image(image, remapper, license_map, id_map, written) == dict(image, license=10)
+    # Repeated records of an image within a dataset (e.g., one per face) keep its id, and identical ones are dropped
+    assert remap_image(dict(image), remapper, license_map, id_map, written) is None
+    assert remap_image(dict(image, width=3), remapper, license_map, id_map, written) == \
+        dict(image, license=10, width=3)
+    assert id_map == {1: 1}
+
+    # Ids that collide with the ones of a previous dataset are remapped, once per image
+    id_map, written = dict(), set()
+    assert remap_image(dict(image, file_name='b.jpg'), remapper, {}, id_map, written)['id'] == 2
+    assert remap_image(dict(image, file_name='b.jpg'), remapper, {}, id_map, written) is None
+    assert remap_image({'id': 2, 'file_name': 'c.jpg'}, remapper, {}, id_map, written)['id'] == 3
+    assert id_map == {1: 2, 2: 3}
+    assert remapper.num_remapped == 2
+
+
+def test_dedup_entries():
+    merged, remapper = dict(), IdRemapper()
+    assert dedup_entries([{'id': 0, 'name': 'face'}, {'id': 1, 'name': 'person'}], merged, remapper) == {0: 0, 1: 1}
+    assert dedup_entries([{'id': 0, 'name': 'person'}, {'id': 1, 'name': 'car'}], merged, remapper) == {0: 1, 1: 2}
+    assert list(merged.values()) == [{'id': 0, 'name': 'face'}, {'id': 1, 'name': 'person'}, {'id': 2, 'name': 'car'}]
+
+
+def test_merge_info():
+    assert merge_info(['AFLW', 'WIDER']) == 'AFLW | WIDER'
+    assert merge_info([2011, 2016]) == 2016
+    assert merge_info([{'year': 2011, 'a': 'x'}, {'year': 2016}]) == {'year': 2016, 'a': 'x'}
+
+
+def make_dataset(image_ids, first_ann_id, annotations_first=False):
+    # One image record per annotation (i.e., per face), as written by the original converter
+    images = [{'id': image_id, 'file_name': '{}.jpg'.format(image_id), 'license': 1} for image_id in image_ids]
+    annotations = [{'id': first_ann_id + i, 'image_id': image_id, 'category_id': 0}
+                   for i, image_id in enumerate(image_ids)]
+    dataset = {'licenses': [{'id': 1, 'name': 'CC'}], 'categories': [{'id': 0, 'name': 'face'}]}
+    if annotations_first:
+        return dict(dataset, annotations=annotations, images=images)
+    return dict(dataset, images=images, annotations=annotations)
+
+
+@pytest.mark.parametrize('annotations_first', [False, True])
+def test_merge(tmp_path, monkeypatch, annotations_first):
+    first = str(tmp_path / 'first.json')
+    second = str(tmp_path / 'second.json.gz')
+    merged = str(tmp_path / 'merged.json')
+    save_json(make_dataset([1, 1, 2, 3, 3, 3], 1), first)
+    save_json(make_dataset([3, 4, 4], 1, annotations_first=annotations_first), second)
+    monkeypatch.setattr(sys, 'argv', ['merge_annotations.py', '-m', merged, first, second])
+    merge_annotations.main()
+
+    dataset = load_json(merged)
+    images = {image['id']: image['file_name'] for image in dataset['images']}
+    assert len(images) == len(dataset['images']) == 5
+    assert len(dataset['annotations']) == 9
+    assert len({annotation['id'] for annotation in dataset['annotations']}) == 9
+    # Every annotation refers to the image it was annotated on (file names are unique to each image)
+    image_names = ['1.jpg', '1.jpg', '2.jpg', '3.jpg', '3.jpg', '3.jpg', '3.jpg', '4.jpg', '4.jpg']
+    assert [images[annotation['image_id']] for annotation in dataset['annotations']] == image_names
+    # Image 3 of the second file collides with image 3 of the first one, and is remapped
+    assert len({annotation['image_id'] for annotation in dataset['annotations'][3:7]}) == 2
+    assert dataset['categories'] == [{'id': 0, 'name': 'face'}]
+    assert dataset['licenses'] == [{'id': 1, 'name': 'CC'}]